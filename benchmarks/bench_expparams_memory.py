@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+'''
+Benchmark for the memory used by the ExpParams of a large sweep.
+
+Builds a grid of N ExpParams by + composition of the values of four
+hyperparameters (as a sweep script would), and reports the time and the
+growth of the peak resident memory per point.
+
+Usage: python benchmarks/bench_expparams_memory.py [num_points]
+'''
+
+import sys
+import time
+import resource
+from pypipeline.experiment_runner import ExpParams
+
+def get_peak_rss_megs():
+    '''Gets the peak resident memory of this process in megabytes (on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def get_grid(num_points):
+    defaults = ExpParams(dataset="news", model="crf", iters=10)
+    defaults.set("seed", 1, incl_name=False)
+    side = int(round(num_points ** 0.25))
+    lrs = [ExpParams(lr=0.1 * i) for i in range(side)]
+    regs = [ExpParams(reg=0.01 * i) for i in range(side)]
+    batches = [ExpParams(batch=2 ** i) for i in range(side)]
+    exps = []
+    i = 0
+    while len(exps) < num_points:
+        for lr in lrs:
+            for reg in regs:
+                for batch in batches:
+                    if len(exps) >= num_points:
+                        return exps
+                    exps.append(defaults + lr + reg + batch + ExpParams(trial=i))
+        i += 1
+    return exps
+
+def main(num_points):
+    start_megs = get_peak_rss_megs()
+    start = time.time()
+    exps = get_grid(num_points)
+    elapsed = time.time() - start
+    megs = get_peak_rss_megs() - start_megs
+    print "%-10s %10s %12s %14s" % ("points", "seconds", "peak MB", "bytes/point")
+    print "%-10d %10.2f %12.1f %14.0f" % (len(exps), elapsed, megs, megs * 1024 * 1024 / len(exps))
+
+if __name__ == "__main__":
+    num_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    main(num_points)
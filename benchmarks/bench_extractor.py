@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+'''
+Benchmark for extracting many metrics from a log.
+
+Writes a synthetic log with a few matching lines per metric among many lines
+of noise, then extracts the last value of each metric with one get_following
+call per metric (one pass over the lines each) and with a single LogExtractor
+pass over the file.
+
+Usage: python benchmarks/bench_extractor.py [num_lines] [num_metrics]
+'''
+
+import os
+import sys
+import time
+import random
+import tempfile
+from pypipeline.util import get_following_literal, LogExtractor, LAST
+
+def write_log(path, num_lines, num_metrics):
+    out = open(path, 'w')
+    for i in range(num_lines):
+        if i % 1000 == 0:
+            out.write("metric%d: %f\n" % (random.randrange(num_metrics), random.random()))
+        else:
+            out.write("INFO iteration %d objective %f\n" % (i, random.random()))
+    out.close()
+
+def main(num_lines, num_metrics):
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        write_log(path, num_lines, num_metrics)
+        prefixes = ["metric%d: " % (m) for m in range(num_metrics)]
+
+        start = time.time()
+        lines = open(path, 'r').readlines()
+        separate = dict((p, get_following_literal(lines, p, -1)) for p in prefixes)
+        separate_secs = time.time() - start
+
+        start = time.time()
+        extractor = LogExtractor()
+        for p in prefixes:
+            extractor.add_following_literal(p, p, LAST)
+        combined = extractor.extract_file(path)
+        combined_secs = time.time() - start
+
+        assert separate == combined
+        print "%-12s %-10s %10s" % ("method", "metrics", "seconds")
+        print "%-12s %-10d %10.3f" % ("separate", num_metrics, separate_secs)
+        print "%-12s %-10d %10.3f" % ("extractor", num_metrics, combined_secs)
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    num_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    num_metrics = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    main(num_lines, num_metrics)
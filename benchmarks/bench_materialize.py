@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+'''
+Benchmark for creating the directories and scripts of a large pipeline.
+
+Runs N independent ExpParams stages on the queue with a FakeScheduler (so that
+nothing is submitted), in a temporary directory, and reports the total time.
+PipelineRunner also prints the time of each phase. To measure a network file
+system, pass a directory on it as the second argument.
+
+Usage: python benchmarks/bench_materialize.py [num_stages] [dir]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from pypipeline.experiment_runner import ExpParams, ExpParamsRunner
+from pypipeline.scheduler import FakeScheduler
+
+class BenchExp(ExpParams):
+
+    def get_instance(self):
+        return BenchExp()
+
+    def create_experiment_script(self, exp_dir):
+        return "echo %s\n" % (self.get_args())
+
+def main(n, dir):
+    work_dir = tempfile.mkdtemp(prefix="bench_materialize", dir=dir)
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        os.mkdir("exp")
+        open("setupenv.sh", 'w').close()
+        exps = [BenchExp(lr=0.1 * (i % 10), reg=0.01 * (i / 10 % 10), trial=i / 100) for i in range(n)]
+        runner = ExpParamsRunner("bench", "cpu", scheduler=FakeScheduler())
+        start = time.time()
+        runner.run_experiments(exps)
+        elapsed = time.time() - start
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+    print "%-10s %10s" % ("stages", "seconds")
+    print "%-10d %10.2f" % (n, elapsed)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    dir = sys.argv[2] if len(sys.argv) > 2 else None
+    main(n, dir)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+'''
+Benchmark for naming the stages of a large sweep.
+
+Builds N ExpParams varying three of their seven keys, then times shorten_names
+and the repeated calls to get_name (as made by _check_stages, run_pipeline,
+get_qsub_name and the print statements) and get_args.
+
+Usage: python benchmarks/bench_names.py [num_stages] [calls_per_stage]
+'''
+
+import sys
+import time
+from pypipeline.experiment_runner import ExpParams, shorten_names
+
+def get_exps(n):
+    base = ExpParams(dataset="news", model="crf", iters=10, tol=1e-4)
+    base.set("seed", 1, incl_name=False)
+    return [base + ExpParams(lr=0.1 * (i % 10), reg=0.01 * (i / 10 % 10), trial=i / 100) for i in range(n)]
+
+def timed(f):
+    start = time.time()
+    f()
+    return time.time() - start
+
+def main(n, calls):
+    exps = get_exps(n)
+    results = []
+    results.append(("shorten_names", timed(lambda: shorten_names(exps))))
+    results.append(("get_name x%d" % (calls), timed(lambda: [e.get_name() for _ in range(calls) for e in exps])))
+    results.append(("get_args x%d" % (calls), timed(lambda: [e.get_args() for _ in range(calls) for e in exps])))
+    print "%-16s %10s" % ("step", "seconds")
+    for step, elapsed in results:
+        print "%-16s %10.3f" % (step, elapsed)
+    print "%-16s %10.3f" % ("total", sum([r[1] for r in results]))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    main(n, calls)
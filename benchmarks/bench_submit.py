@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+Benchmark for submission throughput using the FakeScheduler.
+
+Runs a sweep of N independent stages plus one summary stage through an
+ExpParamsRunner in queue mode, with and without array jobs, and reports the
+time to submit and the number of jobs the scheduler saw. The fake scheduler
+sleeps for a configurable latency per job to simulate qmaster round trips.
+
+Usage: python benchmarks/bench_submit.py [num_stages] [job_latency_secs]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from pypipeline.experiment_runner import ExpParamsRunner, PythonExpParams
+from pypipeline.pipeline import RootStage, ScriptStringStage
+from pypipeline.scheduler import FakeScheduler
+
+class SweepExpParams(PythonExpParams):
+
+    def __init__(self, dictionary=None, **keywords):
+        PythonExpParams.__init__(self, dictionary if dictionary is not None else {}, **keywords)
+
+    def get_instance(self):
+        return SweepExpParams()
+
+    def create_experiment_script(self, exp_dir):
+        return "echo %s\n" % (self.get_args())
+
+def get_pipeline(n):
+    root = RootStage()
+    summary = ScriptStringStage("summary", "echo done")
+    for i in range(n):
+        exp = SweepExpParams(seed=i)
+        root.add_dependent(exp)
+        exp.add_dependent(summary)
+    return root
+
+def main(n, job_latency_secs):
+    top_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(top_dir)
+        open("setupenv.sh", 'w').close()
+        os.mkdir("exp")
+        results = []
+        for array_jobs in [False, True]:
+            scheduler = FakeScheduler(job_latency_secs=job_latency_secs)
+            runner = ExpParamsRunner("bench", "cpu", array_jobs=array_jobs, scheduler=scheduler)
+            root = get_pipeline(n)
+            # Silence the per-stage output.
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            start = time.time()
+            try:
+                runner.run_pipeline(root)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+                os.chdir(top_dir)
+            elapsed = time.time() - start
+            results.append((array_jobs, len(scheduler.jobs), elapsed))
+        print "%-12s %-10s %-10s %10s %14s" % ("array_jobs", "stages", "jobs", "seconds", "stages/sec")
+        for array_jobs, num_jobs, elapsed in results:
+            print "%-12s %-10d %-10d %10.3f %14.1f" % (array_jobs, n + 1, num_jobs, elapsed, (n + 1) / elapsed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(top_dir)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    job_latency_secs = float(sys.argv[2]) if len(sys.argv) > 2 else 0.001
+    main(n, job_latency_secs)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+'''
+Benchmark for util.tail on large logs.
+
+Writes a log of the given size whose lines have the given length (e.g. the
+long stack traces of a Java log), then times the last 500 lines with
+util.tail and with the previous implementation, which prepended 1 KB chunks.
+The previous implementation is quadratic in the bytes read (e.g. about 90
+seconds for 16 MB of 10 KB lines), so it is skipped above legacy_max_megs.
+
+Usage: python benchmarks/bench_tail.py [megabytes] [line_length] [window] [legacy_max_megs]
+'''
+
+import os
+import sys
+import time
+import tempfile
+from pypipeline.util import tail, reverse_byte_generator
+
+def legacy_tail(filename, window=20):
+    '''The previous implementation of util.tail.'''
+    num_lines = 0
+    all_chunks = ''
+    for chunk in reverse_byte_generator(filename):
+        num_lines = chunk.count('\n')
+        all_chunks = chunk + all_chunks
+        if num_lines >= window:
+            break
+    lines = all_chunks.splitlines(True)
+    return lines[-window:]
+
+def write_log(path, megs, line_length):
+    line = ("x" * (line_length - 1)) + "\n"
+    block = line * max(1, (1024 * 1024) / line_length)
+    out = open(path, 'w')
+    written = 0
+    while written < megs * 1024 * 1024:
+        out.write(block)
+        written += len(block)
+    out.close()
+
+def time_tail(f, path, window):
+    start = time.time()
+    lines = f(path, window)
+    return len(lines), time.time() - start
+
+def main(megs, line_length, window, legacy_max_megs):
+    fd, path = tempfile.mkstemp(suffix=".log")
+    os.close(fd)
+    try:
+        write_log(path, megs, line_length)
+        print "%-8s %-12s %-8s %-8s %10s" % ("megs", "line_length", "method", "lines", "seconds")
+        for name, f in [("mmap", tail), ("legacy", legacy_tail)]:
+            if f == legacy_tail and megs > legacy_max_megs:
+                print "%-8d %-12d %-8s skipped (above legacy_max_megs=%d)" % (megs, line_length, name, legacy_max_megs)
+                continue
+            num_lines, elapsed = time_tail(f, path, window)
+            print "%-8d %-12d %-8s %-8d %10.3f" % (megs, line_length, name, num_lines, elapsed)
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    megs = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    line_length = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    window = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    legacy_max_megs = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    main(megs, line_length, window, legacy_max_megs)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+'''
+Benchmark for the stage graph traversals in pypipeline.topological.
+
+Times the traversals on wide (root -> N stages -> sink) and deep (chain of N
+stages) pipelines, and compares against the previous recursive implementations
+on stacked diamonds, where the number of paths grows exponentially with depth.
+
+Usage: python benchmarks/bench_traversal.py [num_stages]
+'''
+
+import sys
+import time
+from pypipeline import topological
+from pypipeline.pipeline import NamedStage, RootStage
+
+def legacy_dfs_stages(stage):
+    stages = set()
+    stages.add(stage)
+    for dependent in stage.dependents:
+        for s in legacy_dfs_stages(dependent):
+            if not s in stages:
+                stages.add(s)
+    return stages
+
+def legacy_bfs_stages(stage):
+    stages = set()
+    queue = [stage]
+    while queue != []:
+        stage = queue.pop(0)
+        if not stage in stages:
+            stages.add(stage)
+        queue.extend(stage.dependents)
+    return stages
+
+def get_wide_pipeline(n):
+    root = RootStage()
+    sink = NamedStage("sink")
+    for i in range(n):
+        s = NamedStage("wide%d" % i)
+        root.add_dependent(s)
+        s.add_dependent(sink)
+    return root
+
+def get_deep_pipeline(n):
+    root = RootStage()
+    prev = root
+    for i in range(n):
+        s = NamedStage("deep%d" % i)
+        prev.add_dependent(s)
+        prev = s
+    return root
+
+def get_diamonds_pipeline(depth):
+    '''Stacked diamonds: every stage in a layer of two feeds both stages in the next.'''
+    root = RootStage()
+    layer = [root]
+    for d in range(depth):
+        next_layer = [NamedStage("diamond%d_%d" % (d, i)) for i in range(2)]
+        for p in layer:
+            p.add_dependents(next_layer)
+        layer = next_layer
+    return root
+
+def timeit(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+def main(n):
+    print "%-12s %-10s %-16s %10s" % ("graph", "stages", "traversal", "seconds")
+    for graph_name, get_pipeline in [("wide", get_wide_pipeline), ("deep", get_deep_pipeline)]:
+        for size in [n / 100, n / 10, n]:
+            root = get_pipeline(size)
+            for name, f in [("dfs_order", topological.dfs_order),
+                            ("bfs_order", topological.bfs_order),
+                            ("topo_sort", topological.topo_sort_with_levels)]:
+                print "%-12s %-10d %-16s %10.4f" % (graph_name, size, name, timeit(f, root))
+    for depth in [6, 10, 14]:
+        root = get_diamonds_pipeline(depth)
+        for name, f in [("dfs_order", topological.dfs_order),
+                        ("bfs_order", topological.bfs_order),
+                        ("legacy_dfs", legacy_dfs_stages),
+                        ("legacy_bfs", legacy_bfs_stages)]:
+            print "%-12s %-10d %-16s %10.4f" % ("diamonds", 2 * depth, name, timeit(f, root))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    main(n)
@@ -0,0 +1,79 @@
+'''
+Submission of sibling stages as array jobs.
+
+@author: mgormley
+'''
+
+from collections import OrderedDict
+from util import get_new_file
+from scheduler import MultiStageJob, MultiStageSubmitter
+
+class ArrayJob(MultiStageJob):
+    '''A single array job which runs the scripts of several stages, one per task.
+
+    The index file has one line per task, where line i (for task id i) holds the
+    tab-separated task id, stage directory, script file and stdout file of a stage.
+    All the tasks share the job name.
+    '''
+
+    def __init__(self, stages, exp_dir):
+        MultiStageJob.__init__(self, "array", stages, exp_dir)
+        self.qsub_args = stages[0].qsub_args
+        self.tasks = (1, len(stages))
+
+    def write_index(self):
+        out, self.index_file = get_new_file(prefix="array-index", suffix=".txt", dir=self.cwd)
+        for i, stage in enumerate(self.stages):
+            out.write("\t".join([str(i + 1), stage.cwd, stage.script_file, stage.stdout_path]) + "\n")
+        out.close()
+
+    def write_script(self, task_id_var):
+        script = ""
+        script += "# Look up the stage for this task in the index.\n"
+        script += "LINE=\"$(sed -n \"${%s}p\" '%s')\"\n" % (task_id_var, self.index_file)
+        script += "STAGE_DIR=\"$(echo \"$LINE\" | cut -f 2)\"\n"
+        script += "SCRIPT=\"$(echo \"$LINE\" | cut -f 3)\"\n"
+        script += "STDOUT=\"$(echo \"$LINE\" | cut -f 4)\"\n"
+        script += "cd \"$STAGE_DIR\"\n"
+        script += "bash \"$SCRIPT\" > \"$STDOUT\" 2>&1\n"
+        self._write_script(script)
+
+class ArrayJobSubmitter(MultiStageSubmitter):
+    '''Submits the scripts of queued stages, grouping siblings into array jobs.
+
+    Stages are grouped if they have identical qsub_args and prereqs. Each group of
+    two or more stages is submitted as a single array job with one task per stage,
+    and the other stages are submitted as usual. The qsub script of each stage of an
+    array job resubmits only that stage's task.
+    '''
+
+    def __init__(self, scheduler, exp_dir):
+        MultiStageSubmitter.__init__(self, scheduler)
+        self.exp_dir = exp_dir
+
+    def get_stage_submit_command(self, array, i):
+        '''Overriding method for MultiStageSubmitter.'''
+        return self.scheduler.get_submit_command(array.script_file, array.stages[i].cwd, array.get_qsub_name(),
+                                                 array.get_prereq_hold_names(), array.stdout_path,
+                                                 array.qsub_args, (i + 1, i + 1))
+
+    def get_jobs(self):
+        '''Overriding method for QueueSubmitter.'''
+        # Group by qsub args and prereqs. Every group is ordered after the groups
+        # of its prereqs, since the stages were added in topological order.
+        groups = OrderedDict()
+        for stage in self.stages:
+            key = (stage.qsub_args, frozenset(stage.prereqs))
+            groups.setdefault(key, []).append(stage)
+        jobs = []
+        for group in groups.values():
+            if len(group) == 1:
+                jobs.append(group[0])
+                continue
+            array = ArrayJob(group, self.exp_dir)
+            for stage in group:
+                stage.parent_job = array
+            array.write_index()
+            array.write_script(self.scheduler.task_id_var)
+            jobs.append(array)
+        return jobs
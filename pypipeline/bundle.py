@@ -0,0 +1,108 @@
+'''
+Submission of many short stages packed into a few bundle jobs.
+
+@author: mgormley
+'''
+
+from collections import OrderedDict
+from scheduler import MultiStageJob, MultiStageSubmitter
+
+class BundleJob(MultiStageJob):
+    '''A single job which runs the scripts of several stages, in one or more lanes.
+
+    The lanes run in parallel, and each lane runs its stages one after another. Each
+    stage is run in its own directory with its own stdout file, and its script touches
+    its own completion indicator, as if it were submitted alone.
+    '''
+
+    def __init__(self, num_lanes, exp_dir):
+        MultiStageJob.__init__(self, "bundle", [], exp_dir)
+        self.lanes = [[] for _ in range(num_lanes)]
+        self.loads = [0] * num_lanes # The minutes of the stages in each lane.
+
+    def get_minutes(self):
+        '''Gets the predicted wall-clock minutes: those of the longest lane.'''
+        return max(self.loads)
+
+    def try_add(self, stage, max_minutes):
+        '''Adds the stage to the least loaded lane, unless that would take the lane over
+        max_minutes. Returns whether the stage was added.'''
+        lane = self.loads.index(min(self.loads))
+        if self.loads[lane] + stage.minutes > max_minutes:
+            return False
+        self.lanes[lane].append(stage)
+        self.loads[lane] += stage.minutes
+        self.stages.append(stage)
+        return True
+
+    def write_script(self):
+        script = "FAILED=0\n"
+        for lane in self.lanes:
+            if len(lane) == 0:
+                continue
+            script += "(\n"
+            script += "    LANE_FAILED=0\n"
+            for stage in lane:
+                script += "    cd '%s' && bash '%s' > '%s' 2>&1 || { echo 'Stage failed: %s'; LANE_FAILED=1; }\n" % \
+                    (stage.cwd, stage.script_file, stage.stdout_path, stage.get_name())
+            script += "    exit $LANE_FAILED\n"
+            script += ") &\n"
+            script += "LANES=\"$LANES $!\"\n"
+        script += "for LANE in $LANES ; do\n"
+        script += "    wait $LANE || FAILED=1\n"
+        script += "done\n"
+        script += "exit $FAILED\n"
+        self._write_script(script)
+
+class BundleSubmitter(MultiStageSubmitter):
+    '''Submits the scripts of queued stages, packing short independent stages into bundle jobs.
+
+    Stages are grouped if they have the same threads, work_mem_megs and prereqs. Each
+    group is packed (first fit, longest stages first) into bundles of num_lanes lanes,
+    where the minutes of the stages in each lane add up to at most max_minutes. A bundle
+    requests num_lanes times the threads and memory of its stages and the minutes of its
+    longest lane. Bundles of a single stage, and stages longer than max_minutes, are
+    submitted as usual.
+    '''
+
+    def __init__(self, scheduler, exp_dir, queue, max_minutes, num_lanes=1):
+        MultiStageSubmitter.__init__(self, scheduler)
+        self.exp_dir = exp_dir
+        self.queue = queue
+        self.max_minutes = max_minutes
+        self.num_lanes = num_lanes
+
+    def get_jobs(self):
+        '''Overriding method for QueueSubmitter.'''
+        # Group by resources and prereqs. Every group is ordered after the groups
+        # of its prereqs, since the stages were added in topological order.
+        groups = OrderedDict()
+        for stage in self.stages:
+            key = (stage.threads, stage.work_mem_megs, frozenset(stage.prereqs))
+            groups.setdefault(key, []).append(stage)
+        jobs = []
+        for (threads, work_mem_megs, _), group in groups.items():
+            bundles = []
+            for stage in sorted(group, key=lambda s: -s.minutes):
+                if stage.minutes > self.max_minutes:
+                    jobs.append(stage)
+                    continue
+                for bundle in bundles:
+                    if bundle.try_add(stage, self.max_minutes):
+                        break
+                else:
+                    bundle = BundleJob(self.num_lanes, self.exp_dir)
+                    bundle.try_add(stage, self.max_minutes)
+                    bundles.append(bundle)
+            for bundle in bundles:
+                if len(bundle.stages) == 1:
+                    jobs.append(bundle.stages[0])
+                    continue
+                num_lanes = len([lane for lane in bundle.lanes if len(lane) > 0])
+                bundle.qsub_args = self.scheduler.get_resource_args(self.queue, threads * num_lanes,
+                                                                    work_mem_megs * num_lanes, bundle.get_minutes())
+                for stage in bundle.stages:
+                    stage.parent_job = bundle
+                bundle.write_script()
+                jobs.append(bundle)
+        return jobs
@@ -0,0 +1,82 @@
+'''
+Submission of linear chains of stages as single jobs.
+
+@author: mgormley
+'''
+
+from scheduler import MultiStageJob, MultiStageSubmitter
+
+class ChainJob(MultiStageJob):
+    '''A single job which runs the scripts of a chain of stages, one after another.
+
+    Each stage is run in its own directory with its own stdout file, and its script
+    touches its own completion indicator, as if it were submitted alone. The job stops
+    at the first stage which fails.
+    '''
+
+    def __init__(self, stages, exp_dir):
+        MultiStageJob.__init__(self, "chain", stages, exp_dir)
+
+    def write_script(self):
+        script = ""
+        for stage in self.stages:
+            script += "cd '%s' && bash '%s' > '%s' 2>&1 || { echo 'Stage failed: %s'; exit 1; }\n" % \
+                (stage.cwd, stage.script_file, stage.stdout_path, stage.get_name())
+        self._write_script(script)
+
+class ChainSubmitter(MultiStageSubmitter):
+    '''Submits the scripts of queued stages, fusing linear chains of stages into single jobs.
+
+    A stage is fused with its prereq if it is its only prereq and it is the only dependent
+    of that prereq (e.g. preprocess -> train -> decode -> eval), so that the chain pays the
+    queue latency once rather than once per stage. A chain job requests the most threads
+    and memory of its stages and the sum of their minutes. Other stages are submitted as
+    usual.
+    '''
+
+    def __init__(self, scheduler, exp_dir, queue):
+        MultiStageSubmitter.__init__(self, scheduler)
+        self.exp_dir = exp_dir
+        self.queue = queue
+
+    def get_stage_submit_command(self, chain, i):
+        '''Overriding method for MultiStageSubmitter.'''
+        if i == 0:
+            return MultiStageSubmitter.get_stage_submit_command(self, chain, i)
+        # Hold on the relaunch of the previous stage, rather than on the chain.
+        stage = chain.stages[i]
+        return self.scheduler.get_submit_command(stage.script_file, stage.cwd, stage.get_qsub_name(),
+                                                 [chain.stages[i - 1].get_qsub_name()], stage.stdout_path,
+                                                 stage.qsub_args)
+
+    def get_jobs(self):
+        '''Overriding method for QueueSubmitter.'''
+        # Since the stages were added in topological order, each stage comes after the
+        # rest of its chain, and each chain after the prereqs of its first stage.
+        chains = {} # Map from the first stage of each chain to the chain.
+        chain_of = {} # Map from each stage to the first stage of its chain.
+        for stage in self.stages:
+            first = stage
+            if len(stage.prereqs) == 1:
+                prereq = stage.prereqs[0]
+                if prereq in chain_of and len(prereq.dependents) == 1:
+                    first = chain_of[prereq]
+            chain_of[stage] = first
+            chains.setdefault(first, []).append(stage)
+        jobs = []
+        for stage in self.stages:
+            chain = chains.get(stage)
+            if chain is None:
+                continue
+            if len(chain) == 1:
+                jobs.append(stage)
+                continue
+            job = ChainJob(chain, self.exp_dir)
+            job.qsub_args = self.scheduler.get_resource_args(self.queue, max([s.threads for s in chain]),
+                                                             max([s.work_mem_megs for s in chain]),
+                                                             sum([s.minutes for s in chain]))
+            for s in chain:
+                s.parent_job = job
+            job.write_script()
+            jobs.append(job)
+        return jobs
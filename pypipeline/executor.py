@@ -0,0 +1,150 @@
+'''
+Local parallel execution of pipeline stages.
+
+@author: mgormley
+'''
+
+import os
+import sys
+import shlex
+import time
+import heapq
+import subprocess
+import multiprocessing
+from subprocess import Popen
+from topological import get_bottom_levels
+
+def get_num_cores():
+    '''Gets the number of cores on this machine.'''
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def get_phys_mem_megs():
+    '''Gets the megabytes of physical memory on this machine, or None if unknown.'''
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class LocalExecutor:
+    '''Runs the scripts of serial stages as local subprocesses, in parallel.
+
+    A stage is launched as soon as all of its prereqs (that were added to this
+    executor) have completed successfully. Of the stages which are ready, those
+    with the longest paths of minutes after them (see get_bottom_levels) are
+    launched first, so that the critical path starts early. While it runs, a
+    stage reserves its threads and work_mem_megs from the budget of max_threads
+    and max_mem_megs, which default to the cores and physical memory of this
+    machine. A stage which requests more than the whole budget is run by itself.
+
+    If a stage fails, no further stages are launched, the running stages are
+    allowed to finish, and a CalledProcessError is raised.
+    '''
+
+    def __init__(self, max_threads=None, max_mem_megs=None, poll_secs=0.05):
+        if max_threads is None:
+            max_threads = get_num_cores()
+        if max_mem_megs is None:
+            max_mem_megs = get_phys_mem_megs()
+        self.max_threads = max_threads
+        self.max_mem_megs = max_mem_megs
+        self.poll_secs = poll_secs
+        self.jobs = [] # List of (stage, command, cwd, stdout_path) in the order added.
+
+    def add(self, stage, script_file, cwd, stdout_path):
+        '''Adds a stage to be run. The prereqs of a stage must be added before it.'''
+        command = "bash %s" % (script_file)
+        self.jobs.append((stage, command, cwd, stdout_path))
+
+    def run(self):
+        '''Runs all the added stages and returns once they have all completed.'''
+        if len(self.jobs) == 0:
+            return
+        print "Running %d stages locally with max_threads=%s max_mem_megs=%s" % \
+            (len(self.jobs), self.max_threads, self.max_mem_megs)
+        # Count the prereqs of each stage which are run by this executor.
+        # Other prereqs (e.g. the root stage or completed stages) are already done.
+        index = dict((job[0], i) for i, job in enumerate(self.jobs))
+        levels = get_bottom_levels([job[0] for job in self.jobs], lambda stage: stage.minutes or 0)
+        # The ready heap is ordered by the critical path, then by the order added.
+        keys = [(-levels[job[0]], i) for i, job in enumerate(self.jobs)]
+        num_waiting = [0] * len(self.jobs)
+        ready = []
+        for i, job in enumerate(self.jobs):
+            num_waiting[i] = len([p for p in job[0].prereqs if p in index])
+            if num_waiting[i] == 0:
+                heapq.heappush(ready, keys[i])
+
+        running = {} # Map from Popen to (job index, stdout file).
+        used_threads, used_mem = 0, 0
+        failed = None
+        # Once a stage has failed, nothing more is launched, so only wait for the running stages.
+        while len(running) > 0 or (failed is None and len(ready) > 0):
+            # Launch as many ready stages as fit in the budget, critical path first.
+            if failed is None:
+                deferred = []
+                while len(ready) > 0:
+                    key = heapq.heappop(ready)
+                    i = key[1]
+                    threads, mem = self._get_demand(self.jobs[i][0])
+                    if len(running) > 0 and not self._fits(used_threads + threads, used_mem + mem):
+                        deferred.append(key)
+                        continue
+                    p, stdout = self._launch(self.jobs[i])
+                    running[p] = (i, stdout)
+                    used_threads += threads
+                    used_mem += mem
+                for key in deferred:
+                    heapq.heappush(ready, key)
+            # Reap any finished stages.
+            finished = [p for p in running if p.poll() is not None]
+            if len(finished) == 0:
+                time.sleep(self.poll_secs)
+                continue
+            for p in finished:
+                i, stdout = running.pop(p)
+                stdout.close()
+                stage, command, cwd, stdout_path = self.jobs[i]
+                threads, mem = self._get_demand(stage)
+                used_threads -= threads
+                used_mem -= mem
+                if p.returncode != 0:
+                    print "Failed stage:", stage.get_name()
+                    if failed is None:
+                        failed = (p.returncode, command, stdout_path)
+                    continue
+                print "Finished stage:", stage.get_name()
+                for dependent in stage.dependents:
+                    j = index.get(dependent)
+                    if j is not None:
+                        num_waiting[j] -= 1
+                        if num_waiting[j] == 0:
+                            heapq.heappush(ready, keys[j])
+        if failed is not None:
+            retcode, command, stdout_path = failed
+            # Print out the last few lines of the failed stage's stdout file.
+            os.system("tail -n 15 %s" % (stdout_path))
+            raise subprocess.CalledProcessError(retcode, command)
+
+    def _launch(self, job):
+        stage, command, cwd, stdout_path = job
+        print "Launching stage:", stage.get_name()
+        sys.stdout.flush()
+        stdout = open(stdout_path, 'w')
+        p = Popen(args=shlex.split(command), cwd=cwd, stderr=subprocess.STDOUT, stdout=stdout)
+        return p, stdout
+
+    def _get_demand(self, stage):
+        '''Gets the threads and megabytes reserved by a stage.'''
+        threads = stage.threads if stage.threads is not None else 1
+        mem = stage.work_mem_megs if stage.work_mem_megs is not None else 0
+        return threads, mem
+
+    def _fits(self, threads, mem):
+        if threads > self.max_threads:
+            return False
+        if self.max_mem_megs is not None and mem > self.max_mem_megs:
+            return False
+        return True
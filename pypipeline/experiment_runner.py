@@ -16,12 +16,15 @@ import glob
 import topological
 from util import get_new_directory
 from util import get_new_file
+from schema import EMPTY_SCHEMA, ParamsView, ExcludedKeysView
 from collections import defaultdict
+from bisect import bisect_left, bisect_right
 from pypipeline.pipeline import Stage, PipelineRunner, RootStage, NamedStage
 
 def get_subset(expparams_list, **keywords):
     '''Gets the subset of ExpParams objects for which all the keywords specified
-    are also parameters for that ExpParams.
+    are also parameters for that ExpParams. For many queries over the same list,
+    use an ExpParamsIndex instead.
     '''
     subset = []
     for expparams in expparams_list:
@@ -35,26 +38,142 @@ def get_subset(expparams_list, **keywords):
             subset.append(expparams)
     return subset
 
+class ExpParamsIndex:
+    '''An inverted index over a list of ExpParams objects, for many get_subset() queries.
+
+    For each key, the postings map each value to the set of positions (in the list)
+    of the ExpParams with that value, so a query intersects the postings of its
+    keywords, starting from the smallest. Results are in the order the ExpParams 
+    were added. Note that changes to an ExpParams after it is added are not indexed.
+    '''
+
+    def __init__(self, expparams_list=()):
+        self.expparams = []
+        self.postings = defaultdict(dict) # Map from key to value to set of positions.
+        self.unhashable = defaultdict(list) # Map from key to positions with unhashable values.
+        self.sorted_values = {} # Map from key to sorted numeric values, for range queries.
+        for expparams in expparams_list:
+            self.add(expparams)
+
+    def add(self, expparams):
+        i = len(self.expparams)
+        self.expparams.append(expparams)
+        for key, value in expparams.params.iteritems():
+            try:
+                self.postings[key].setdefault(value, set()).add(i)
+            except TypeError:
+                self.unhashable[key].append(i)
+            self.sorted_values.pop(key, None)
+
+    def get_subset(self, **keywords):
+        '''Gets the ExpParams for which get(key) == value for all the keywords, 
+        as get_subset(expparams_list, **keywords) does.'''
+        return self._get_all(self._match_all(keywords))
+
+    def get_range(self, key, low=None, high=None, include_low=True, include_high=True, **keywords):
+        '''Gets the ExpParams whose numeric value of key is between low and high
+        (either of which may be None for no bound), and which match the keywords.'''
+        values = self._get_sorted_values(key)
+        start, end = 0, len(values)
+        if low is not None:
+            start = (bisect_left if include_low else bisect_right)(values, low)
+        if high is not None:
+            end = (bisect_right if include_high else bisect_left)(values, high)
+        postings = self.postings.get(key, {})
+        matches = set()
+        for value in values[start:end]:
+            matches.update(postings[value])
+        if len(keywords) > 0:
+            matches.intersection_update(self._match_all(keywords))
+        return self._get_all(matches)
+
+    def _match_all(self, keywords):
+        '''Gets the set of positions which match all the keywords.'''
+        if len(keywords) == 0:
+            return set(range(len(self.expparams)))
+        matches = sorted([self._match(k, v) for k, v in keywords.items()], key=len)
+        result = set(matches[0])
+        for m in matches[1:]:
+            result.intersection_update(m)
+        return result
+
+    def _match(self, key, value):
+        '''Gets the set of positions for which get(key) == value.'''
+        postings = self.postings.get(key, {})
+        try:
+            matches = set(postings.get(value, ()))
+        except TypeError:
+            matches = set()
+        # Values which are equal but unhashable (or hash differently) are compared directly.
+        for i in self.unhashable.get(key, ()):
+            if self.expparams[i].get(key) == value:
+                matches.add(i)
+        if value is None:
+            # An ExpParams without the key also matches, since get() returns None.
+            with_key = set()
+            for positions in postings.values():
+                with_key.update(positions)
+            with_key.update(self.unhashable.get(key, ()))
+            matches.update(set(range(len(self.expparams))) - with_key)
+        return matches
+
+    def _get_sorted_values(self, key):
+        values = self.sorted_values.get(key)
+        if values is None:
+            values = sorted([v for v in self.postings.get(key, {}) 
+                             if isinstance(v, (int, long, float)) and not isinstance(v, bool)])
+            self.sorted_values[key] = values
+        return values
+
+    def _get_all(self, positions):
+        return [self.expparams[i] for i in sorted(positions)]
+
+# The types of the values which keep their types in the manifest (see ExpParams.get_typed_params).
+_TYPED_VALUE_TYPES = (type(None), bool, int, long, float, str, unicode)
+
 class ExpParams(Stage):
+    '''A stage defined by a set of parameters.
+
+    The keys and excluded keys are stored in a Schema which is shared by the ExpParams
+    built the same way, and each ExpParams only stores a list of its values (see schema.py).
+    The params, exclude_name_keys and exclude_arg_keys attributes are views which can be
+    read and modified like a dict and sets. 
+    '''
+    
+    kvsep = "\t"
+    paramsep = "\n"
+    none_string = ""
+    key_order = None
+    # The prefix for dummy keys
+    dummy_key_prefix = "__arg__"
+    # The separator for key/value parameters in the argument string
+    args_kvsep = " "
+    # Functions whose scripts are prepended to the experiment script (see add_script_fn).
+    script_fns = ()
+    # The cached (key_order, name) and argument string (see _clear_cache).
+    _name_cache = None
+    _args_cache = None
     
     def __init__(self, dictionary=None, **keywords):
         Stage.__init__(self)
-        self.params = {}
-        self.exclude_name_keys = set()
-        self.exclude_arg_keys = set()
+        self._schema = EMPTY_SCHEMA
+        self._values = []
         if dictionary:
-            self.params.update(dictionary)
+            self._update(dictionary)
         if keywords:
-            self.params.update(keywords)
-        self.kvsep = "\t"
-        self.paramsep = "\n"
-        self.none_string = ""
-        self.key_order = None
-        # The prefix for dummy keys
-        self.dummy_key_prefix = "__arg__"
-        # The separator for key/value parameters in the argument string
-        self.args_kvsep = " "
-        self.script_fns = []
+            self._update(keywords)
+    
+    @property
+    def params(self):
+        return ParamsView(self)
+    
+    @property
+    def exclude_name_keys(self):
+        return ExcludedKeysView(self, "name")
+    
+    @property
+    def exclude_arg_keys(self):
+        return ExcludedKeysView(self, "arg")
        
     def __str__(self):
         return "ExpParams[params=%s exclude_name_keys=%s exclude_arg_keys=%s]" % \
@@ -69,10 +188,13 @@ class ExpParams(Stage):
             script += script_fns(self, exp_dir)
         # Creates and returns the experiment script string. 
         script += self.create_experiment_script(exp_dir)
-        # Write out the experiment parameters to a file
+        # Write out the experiment parameters to the manifest and/or a file
         # Do this after create_experiment_script in case there are additions to the parameters
         # made by that call.
-        self.write(os.path.join(exp_dir, "expparams.txt"))
+        if self.params_manifest is not None:
+            self.params_manifest.add(os.path.basename(exp_dir), self.get_typed_params())
+        if self.params_manifest is None or self.expparams_files:
+            self.write(os.path.join(exp_dir, "expparams.txt"))
         return script
 
     def __add__(self, other):
@@ -87,15 +209,11 @@ class ExpParams(Stage):
             new_exp = other.get_instance()
         else:
             new_exp = self.get_instance()
-        new_exp.params.update(self.params)
-        new_exp.exclude_name_keys.update(self.exclude_name_keys)
-        new_exp.exclude_arg_keys.update(self.exclude_arg_keys)
+        new_exp._merge(self._schema, self._values)
         if isinstance(other, ExpParams):
-            new_exp.params.update(other.params)
-            new_exp.exclude_name_keys.update(other.exclude_name_keys)
-            new_exp.exclude_arg_keys.update(other.exclude_arg_keys)
+            new_exp._merge(other._schema, other._values)
         else:
-            new_exp.params.update(other)
+            new_exp._update(other)
         return new_exp
     
     def copy_with(self, **keywords):
@@ -103,43 +221,87 @@ class ExpParams(Stage):
     
     def update(self, **keywords):
         ''' Adds the keywords as parameters. '''
-        self.params.update(keywords)
+        self._update(keywords)
             
     def set(self, key, value, incl_name=True, incl_arg=True):
-        self.params[key] = value
+        self._set_value(key, value)
         self.set_incl_name(key, incl_name)
         self.set_incl_arg(key, incl_arg)
     
     def set_incl_name(self, key, incl_name):
-        if not incl_name:
-            self.exclude_name_keys.add(key)
-        elif key in self.exclude_name_keys:
-            self.exclude_name_keys.remove(key)
+        self._schema = self._schema.with_excluded("name", key, not incl_name)
+        self._clear_cache()
         
     def set_incl_arg(self, key, incl_arg):
-        if not incl_arg:
-            self.exclude_arg_keys.add(key)
-        elif key in self.exclude_arg_keys:
-            self.exclude_arg_keys.remove(key)
+        self._schema = self._schema.with_excluded("arg", key, not incl_arg)
+        self._clear_cache()
     
     def remove(self, key):
-        if key in self.params:
-            del self.params[key]
+        i = self._schema.index.get(key)
+        if i is not None:
+            self._schema = self._schema.without_key(key)
+            del self._values[i]
+            self._clear_cache()
     
     def get(self, key):
         ''' Returns the value with its true type '''
-        return self.params.get(key,None)
+        i = self._schema.index.get(key)
+        if i is None:
+            return None
+        return self._values[i]
     
     def keys(self):
-        return self.params.keys()
+        return list(self._schema.keys)
+    
+    def add_script_fn(self, script_fn):
+        '''Adds a function script_fn(exp, exp_dir) whose script is prepended to the experiment script.'''
+        self.script_fns = self.script_fns + (script_fn,)
+    
+    def _set_value(self, key, value):
+        i = self._schema.index.get(key)
+        if i is None:
+            self._schema = self._schema.with_key(key)
+            self._values.append(value)
+        else:
+            self._values[i] = value
+        self._clear_cache()
+    
+    def _clear_cache(self):
+        '''Clears the cached name and arguments. This must be called whenever the params
+        or excluded keys change. Note that changes to what get_initial_keys() returns 
+        are not detected.'''
+        if self._name_cache is not None or self._args_cache is not None:
+            self._name_cache = None
+            self._args_cache = None
+    
+    def _update(self, dictionary):
+        for key, value in dictionary.items():
+            self._set_value(key, value)
+    
+    def _merge(self, schema, values):
+        '''Adds the parameters and excluded keys of another ExpParams' schema and values.'''
+        merged, positions = self._schema.concat(schema)
+        if merged is schema and len(self._values) == 0:
+            self._schema, self._values = schema, list(values)
+            self._clear_cache()
+            return
+        new_values = self._values + [None] * (len(merged.keys) - len(self._values))
+        for i, value in zip(positions, values):
+            new_values[i] = value
+        self._schema, self._values = merged, new_values
+        self._clear_cache()
     
     def getstr(self, key):
         ''' Returns a string version of the value '''
         return self._get_as_str(self.get(key))
     
     def add_arg(self, arg):
-        ''' Adds an command line argument which will be printed without its key.'''
-        dummy_key = self.dummy_key_prefix + str(len(self.params))        
+        ''' Adds an command line argument which will be printed without its key.
+        
+        The arguments are printed after the key/value arguments, in the order they were added.
+        (When the params were stored in a dict, they were printed in the dict's arbitrary order.)
+        '''
+        dummy_key = self.dummy_key_prefix + str(len(self._values))        
         self.set(dummy_key, arg, True, True)
     
     def read(self, path):
@@ -149,43 +311,82 @@ class ExpParams(Stage):
             if param == '':
                 continue
             key,value,exclude_name,exclude_arg = param.split(self.kvsep)
-            self.params[key] = self._attempt_to_coerce(value)
+            self._set_value(key, self._attempt_to_coerce(value))
             if exclude_name == "True":
-                self.exclude_name_keys.add(key)
+                self.set_incl_name(key, False)
             if exclude_arg == "True":
-                self.exclude_arg_keys.add(key)
+                self.set_incl_arg(key, False)
 
     def write(self, path):
         ''' Write out parameter names and values to a file '''
-        out = open(path, 'w')
+        # Replace the file rather than rewriting it, since in a rolling run it may be a 
+        # (read-only) link to the stage cache.
+        tmp_path = path + ".%d.tmp" % (os.getpid())
+        out = open(tmp_path, 'w')
         for key,value,exclude_name,exclude_arg in self._get_string_params():
             out.write(self.kvsep.join([key, value, exclude_name, exclude_arg]) + self.paramsep) 
         out.close()
+        os.rename(tmp_path, path)
+    
+    def get_typed_params(self):
+        '''Gets a list of [key, value, exclude_name, exclude_arg] for each parameter, as 
+        written to the manifest (see manifest.py). Unlike write(), values which are None, 
+        booleans, ints, floats or strings keep their types. Other values are converted to strings.
+        '''
+        typed_params = []
+        exclude_name_keys = self._schema.exclude_name_keys
+        exclude_arg_keys = self._schema.exclude_arg_keys
+        for key, value in zip(self._schema.keys, self._values):
+            if not isinstance(value, _TYPED_VALUE_TYPES):
+                value = self._get_as_str(value)
+            typed_params.append([self._get_as_str(key), value, key in exclude_name_keys, key in exclude_arg_keys])
+        return typed_params
+    
+    def read_typed_params(self, typed_params):
+        '''Sets the parameters from a list as returned by get_typed_params.'''
+        for key, value, exclude_name, exclude_arg in typed_params:
+            self._set_value(key, value)
+            if exclude_name:
+                self.set_incl_name(key, False)
+            if exclude_arg:
+                self.set_incl_arg(key, False)
         
     def get_name(self):
         ''' Returns the name of this experiment '''
+        # The name is cached until the params change (see _clear_cache) or key_order is replaced.
+        cache = self._name_cache
+        if cache is not None and cache[0] is self.key_order:
+            return cache[1]
         name = []
+        exclude_name_keys = self._schema.exclude_name_keys
         for key in self.get_name_key_order():
             value = self.get(key)
-            if key not in self.exclude_name_keys:
+            if key not in exclude_name_keys:
                 name.append(self._get_as_str(value).replace(",","-"))
-        return "_".join(name)
+        name = "_".join(name)
+        self._name_cache = (self.key_order, name)
+        return name
     
     def get_args(self):
         ''' Returns a string consisting of the arguments defined by the parameters of this experiment '''
-        args = ""
+        if self._args_cache is not None:
+            return self._args_cache
+        args = []
+        exclude_arg_keys = self._schema.exclude_arg_keys
+        items = zip(self._schema.keys, self._values)
         # Add the key/value arguments.
-        for key,value in sorted(self.params.items()):
-            if key not in self.exclude_arg_keys and not key.startswith(self.dummy_key_prefix):
+        for key,value in sorted(items):
+            if key not in exclude_arg_keys and not key.startswith(self.dummy_key_prefix):
                 if value is None:
-                    args += "--%s " % (self._get_as_str(key))
+                    args.append("--%s " % (self._get_as_str(key)))
                 else:
-                    args += "--%s%s%s " % (self._get_as_str(key), self.args_kvsep, self._get_as_str(value))
-        # Add the additional command line arguments.
-        for key,value in self.params.items():
-            if key not in self.exclude_arg_keys and key.startswith(self.dummy_key_prefix):
-                args += "%s " % (self._get_as_str(value))
-        return args
+                    args.append("--%s%s%s " % (self._get_as_str(key), self.args_kvsep, self._get_as_str(value)))
+        # Add the additional command line arguments, in the order added (see add_arg).
+        for key,value in items:
+            if key not in exclude_arg_keys and key.startswith(self.dummy_key_prefix):
+                args.append("%s " % (self._get_as_str(value)))
+        self._args_cache = "".join(args)
+        return self._args_cache
             
     def _get_as_str(self, value):
         ''' Converts the value to a string '''
@@ -229,16 +430,7 @@ class ExpParams(Stage):
     
     def _get_name_key_order(self):
         '''Creates and returns the name key order.'''
-        key_order = []
-        initial_keys = self.get_initial_keys()
-        all_keys = sorted(self.params.keys())
-        for key in initial_keys:
-            if key in all_keys:
-                key_order.append(key)
-        for key in all_keys:
-            if key not in initial_keys:
-                key_order.append(key)
-        return key_order
+        return list(self._schema.get_name_key_order(self.get_initial_keys()))
     
     def get_initial_keys(self):
         ''' OVERRIDE THIS METHOD '''
@@ -257,10 +449,11 @@ class ExpParams(Stage):
 
 class JavaExpParams(ExpParams):
     
+    hprof = None
+    
     def __init__(self, dictionary=None, **keywords):
         dictionary.update(keywords)
         ExpParams.__init__(self,dictionary)
-        self.hprof = None
         self.set("java_args", "", incl_arg=False, incl_name=False)
             
     def get_java_args(self):
@@ -321,10 +514,11 @@ class JavaExpParams(ExpParams):
 
 class PythonExpParams(ExpParams):
     
+    args_kvsep = "="
+    
     def __init__(self, dictionary=None, **keywords):
         dictionary.update(keywords)
         ExpParams.__init__(self,dictionary)
-        self.args_kvsep = "="
     
     def get_instance(self):
         ''' OVERRIDE THIS METHOD '''
@@ -340,16 +534,22 @@ def get_all_keys(expparams):
 
 def get_nonunique_keys(expparams):
     '''Gets the set of nonunique keys for these expparams.'''
-    key2vals = defaultdict(set)
-    for expparam in expparams:
-        for key,value in expparam.params.items():
-            key2vals[key].add(value)
-    
+    first_values = {}
     nonunique_keys = set()
-    for key in key2vals:
-        if len(key2vals[key]) > 1:
-            nonunique_keys.add(key)
+    for expparam in expparams:
+        _add_nonunique_keys(expparam, first_values, nonunique_keys)
     return nonunique_keys
+
+def _add_nonunique_keys(expparam, first_values, nonunique_keys):
+    '''Adds the keys whose values differ from the first value seen for that key 
+    (in first_values) to nonunique_keys.'''
+    for key, value in expparam.params.iteritems():
+        if key in nonunique_keys:
+            continue
+        if key not in first_values:
+            first_values[key] = value
+        elif first_values[key] != value:
+            nonunique_keys.add(key)
     
 def get_kept_keys(expparams):
     '''Gets the union of the nonunique keys and the initial keys specified by the ExpParams.'''
@@ -371,14 +571,31 @@ def get_exclude_name_keys(expparams):
     
 def shorten_names(expparams):
     '''Shortens the names of a set of expparams.'''
-    kept_keys = get_kept_keys(expparams)
+    # Get the kept keys (see get_kept_keys) in one pass.
+    first_values = {}
+    kept_keys = set()
+    initial_keys = []
     for expparam in expparams:
-        expparam.key_order = filter(lambda x: x in kept_keys, expparam._get_name_key_order())
+        _add_nonunique_keys(expparam, first_values, kept_keys)
+        initial_keys.append(expparam.get_initial_keys())
+    for keys in initial_keys:
+        kept_keys.update(keys)
+    # ExpParams with the same schema and initial keys share the same key order.
+    key_orders = {}
+    for expparam, keys in zip(expparams, initial_keys):
+        cache_key = (id(expparam._schema), tuple(keys))
+        key_order = key_orders.get(cache_key)
+        if key_order is None:
+            key_order = [x for x in expparam._schema.get_name_key_order(keys) if x in kept_keys]
+            key_orders[cache_key] = key_order
+        expparam.key_order = key_order
 
 class ExpParamsRunner(PipelineRunner):
     
-    def __init__(self,name, queue, print_to_console=False, dry_run=False):
-        PipelineRunner.__init__(self, name, queue, print_to_console, dry_run)
+    def __init__(self,name, queue, print_to_console=False, dry_run=False, parallel=False, array_jobs=False,
+                 scheduler=None, rolling=False):
+        PipelineRunner.__init__(self, name, queue, print_to_console, dry_run, rolling=rolling, parallel=parallel, 
+                                array_jobs=array_jobs, scheduler=scheduler)
 
     def run_experiments(self, exp_stages):
         root_stage = RootStage()
@@ -388,6 +605,31 @@ class ExpParamsRunner(PipelineRunner):
     def run_pipeline(self, root_stage):
         self.shorten_names_epstages(root_stage)
         PipelineRunner.run_pipeline(self, root_stage)
+    
+    def run_sweep(self, sweep, base=None):
+        '''Runs the independent experiments of a sweep (see sweep.py), as 
+        run_experiments(list(sweep.get_exps(base))) would, but in a single streaming 
+        pass over the points of the sweep.
+        
+        The names are shortened to the keys which the sweep varies (plus the initial 
+        keys), rather than those which turn out to be nonunique. Duplicate names are 
+        detected as the experiments are generated, which stops the run partway through.
+        '''
+        self._run_stages(self._get_sweep_stages(sweep, base))
+        
+    def _get_sweep_stages(self, sweep, base):
+        varied_keys = sweep.get_varied_keys()
+        names = set()
+        print "All stages:"
+        for exp in sweep.get_exps(base):
+            kept_keys = varied_keys.union(exp.get_initial_keys())
+            exp.key_order = filter(lambda x: x in kept_keys, exp._get_name_key_order())
+            name = exp.get_name()
+            assert name not in names, "ERROR: Multiple stages have the same name: " + name
+            names.add(name)
+            print "\t",name
+            yield exp
+        print "Number of stages:", len(names)
         
     def shorten_names_epstages(self, root_stage):
         # TODO: note that this is only a class-method only
@@ -432,7 +674,7 @@ class ExperimentRunner(PipelineRunner):
         
     def get_stages_as_list(self, root_stage):
         '''This method is overriden to give the provided order for experiments'''
-        return self.bfs_stages(root_stage)
+        return topological.bfs_order(root_stage)
         
     def create_experiment_script(self, name, experiment, exp_dir):
         ''' Override this method '''
@@ -0,0 +1,103 @@
+'''
+A single manifest of the typed parameters of all the stages in an exp tree.
+
+The manifest is a file in the exp tree (next to the stage directories) with one
+JSON line per stage:
+
+    {"name": "news_0.1", "params": [["lr", 0.1, false, false], ["data", "news", false, false], ...]}
+
+where each parameter is a list of its key, value, and whether it is excluded from
+the name and the arguments. Unlike expparams.txt, the values keep their types
+(None, booleans, ints, floats and strings). When the manifest is closed, a last
+line gives the byte offset of each stage's line:
+
+    {"offsets": {"news_0.1": 0, ...}}
+
+so that a single stage's parameters can be read without reading the whole manifest.
+
+@author: mgormley
+'''
+
+import os
+import json
+from pypipeline.util import reverse_line_generator
+
+# The name of the manifest file in an exp tree.
+MANIFEST_FILE = "expparams.jsonl"
+
+class ParamsManifestWriter:
+    '''Writes the manifest of an exp tree, one stage at a time.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.out = open(path, 'w')
+        self.offsets = {}
+
+    def add(self, name, typed_params):
+        '''Appends the typed parameters (see ExpParams.get_typed_params) of the named stage.
+        The line is flushed, so that it can be read by the stages which are already running.'''
+        self.offsets[name] = self.out.tell()
+        # The name is written first, for read_manifest_lines.
+        self.out.write('{"name": %s, "params": %s}\n' % (json.dumps(name), json.dumps(typed_params)))
+        self.out.flush()
+
+    def close(self):
+        '''Writes the byte offsets and closes the manifest.'''
+        if self.out is None:
+            return
+        self.out.write(json.dumps({"offsets": self.offsets}) + "\n")
+        self.out.close()
+        self.out = None
+
+def read_manifest_lines(path):
+    '''Reads the manifest with a single sequential read, and returns a dict mapping
+    each stage's name to its (unparsed) line. The lines can be parsed with parse_manifest_line.'''
+    lines = {}
+    f = open(path, 'r')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    for line in data.splitlines():
+        # Each stage's line begins with its name (see ParamsManifestWriter.add), so the
+        # lines are parsed only as they are needed.
+        if not line.startswith('{"name": '):
+            continue
+        name, _ = json.JSONDecoder().raw_decode(line, len('{"name": '))
+        lines[_to_str(name)] = line
+    return lines
+
+def parse_manifest_line(line):
+    '''Parses a stage's line of the manifest, and returns its typed parameters.'''
+    return [[_to_str(key), _to_str(value), exclude_name, exclude_arg]
+            for key, value, exclude_name, exclude_arg in json.loads(line)["params"]]
+
+def read_manifest_params(path, name):
+    '''Reads the typed parameters of the named stage from a closed manifest by seeking to
+    its line, or from the whole manifest if it was not closed. Returns None if the stage
+    is not in the manifest.'''
+    offsets = None
+    for last_line in reverse_line_generator(path):
+        if last_line.startswith('{"offsets": '):
+            offsets = json.loads(last_line)["offsets"]
+        break
+    if offsets is None:
+        line = read_manifest_lines(path).get(name)
+        return parse_manifest_line(line) if line is not None else None
+    if name not in offsets:
+        return None
+    f = open(path, 'r')
+    try:
+        f.seek(offsets[name])
+        return parse_manifest_line(f.readline())
+    finally:
+        f.close()
+
+def get_manifest_path(top_dir):
+    return os.path.join(top_dir, MANIFEST_FILE)
+
+def _to_str(value):
+    '''Converts the unicode strings returned by json back to str.'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -15,40 +15,35 @@ from subprocess import Popen
 import glob
 #import topsort
 import topological
+from topological import dfs_stages, bfs_stages
+from executor import LocalExecutor
+from scheduler import SgeScheduler, QueueSubmitter, create_queue_command
+from arrayjob import ArrayJobSubmitter
+from bundle import BundleSubmitter
+from chain import ChainSubmitter
 from util import get_new_directory
 from util import get_new_file
+from util import PhaseTimer
 import random
+import itertools
+from multiprocessing.pool import ThreadPool
 from pypipeline.qsub import get_default_qsub_params, get_qsub_args,\
-    get_default_qsub_params
+    get_default_qsub_params, get_mins_as_hrt_str
+from pypipeline.manifest import ParamsManifestWriter, get_manifest_path
+from pypipeline.stagecache import get_stage_hash, unlink_entry
 
 def write_script(prefix, script, dir):
     out, script_file = get_new_file(prefix=prefix,suffix=".sh",dir=dir)
     out.write(script)
     out.write("\n")
+    # As chmod u+x, without running a process.
+    os.fchmod(out.fileno(), os.fstat(out.fileno()).st_mode | stat.S_IXUSR)
     out.close()
-    os.system("chmod u+x '%s'" % (script_file))
     return script_file
 
 def get_files_in_dir(dirname):
     return [f for f in os.listdir(dirname) if os.path.isfile(os.path.join(dirname, f))]
 
-def create_queue_command(script_file, cwd, name="test", prereqs=[], stdout="stdout", qsub_args=None):
-    # Make the stdout file and script_file relative paths to cwd if possible.
-    stdout = os.path.relpath(stdout, cwd)
-    script_file = os.path.relpath(script_file, cwd)
-    # Create the qsub command.
-    queue_command = "qsub "
-    if qsub_args:
-        queue_command += " " + qsub_args + " "
-    else:
-        #queue_command += " -q cpu.q "
-        queue_command += " -q mem.q -q himem.q -l vf=15.5G "
-    queue_command += " -cwd -j y -b y -V -N %s -e stderr -o %s " % (name, stdout)        
-    if len(prereqs) > 0:
-        queue_command += "-hold_jid %s " % (",".join(prereqs))
-    queue_command += "\"bash '%s'\"" % (script_file)
-    return queue_command
-
 unique_num = 0
 def get_unique_name(name):
     global unique_num
@@ -68,27 +63,77 @@ DIR="$( cd -P "$( dirname "$SOURCE" )" && pwd )"
 echo "Changing directory to $DIR"
 cd $DIR
 """
+
+# The file in which a stage's directory records the hash of the inputs it was last run 
+# with, for rolling runs (see PipelineRunner).
+STAGE_HASH_FILE = "stage-hash.txt"
+    
+class CompletionResolver:
+    '''Determines which stages are already completed.
+    
+    A stage is completed iff its completion_indicator exists (relative to the 
+    stage's cwd) and all of its prereqs are completed. The result for each stage 
+    is memoized, so each completion_indicator is checked at most once, and not at
+    all if one of the stage's prereqs is incomplete. A resolver should therefore 
+    be used for a single run of a pipeline: a stage that is incomplete when first
+    checked stays incomplete, as do its dependents.
+    
+    If check_hashes is True (for rolling runs), a stage is completed only if, in 
+    addition, its stage_hash is known and equal to the one recorded in its directory
+    when it was last run, i.e. its inputs have not changed since.
+    '''
+    
+    def __init__(self, check_hashes=False):
+        self.completed = {}
+        self.check_hashes = check_hashes
+        
+    def is_completed(self, stage):
+        if stage not in self.completed:
+            self._resolve_ancestry(stage)
+        return self.completed[stage]
+    
+    def _resolve_ancestry(self, stage):
+        '''Resolves the stage and any unresolved ancestors, prereqs first.'''
+        visiting = set()
+        stack = [(stage, False)]
+        while len(stack) > 0:
+            s, expanded = stack.pop()
+            if s in self.completed:
+                continue
+            if expanded:
+                self.completed[s] = self._resolve(s)
+            elif s not in visiting:
+                visiting.add(s)
+                stack.append((s, True))
+                for prereq in s.prereqs:
+                    if prereq not in self.completed:
+                        stack.append((prereq, False))
     
-def dfs_stages(stage):
-    stages = set()
-    stages.add(stage)
-    #print "stage.name",stage.name
-    #print "stage.dependents",[x.name for x in stage.dependents]
-    for dependent in stage.dependents:
-        for s in dfs_stages(dependent):
-            if not s in stages:
-                stages.add(s)
-    return stages
+    def _resolve(self, stage):
+        for prereq in stage.prereqs:
+            if not self.completed.get(prereq, False):
+                return False
+        if isinstance(stage, RootStage):
+            return True
+        path = stage.completion_indicator
+        if stage.cwd is not None:
+            path = os.path.join(stage.cwd, path)
+        if not os.path.exists(path):
+            return False
+        if self.check_hashes:
+            return stage.stage_hash is not None and stage.stage_hash == read_stage_hash(stage.cwd)
+        return True
 
-def bfs_stages(stage):
-    stages = set()
-    queue = [stage]
-    while queue != []:
-        stage = queue.pop(0)
-        if not stage in stages:
-            stages.add(stage)
-        queue.extend(stage.dependents)
-    return stages
+def read_stage_hash(cwd):
+    '''Reads the hash recorded in a stage's directory, or returns None if there is none.'''
+    try:
+        f = open(os.path.join(cwd, STAGE_HASH_FILE), 'r')
+    except IOError:
+        return None
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
 
 class Stage:
     '''A stage in a pipeline to be run after the stages in prereqs and before the 
@@ -96,50 +141,103 @@ class Stage:
     
     Attributes:
         cwd: Current working directory for this stage (Set by PipelineRunner).
-        serial: True iff this stage will be run in a pipeline using bash, one stage at a time (Set by PipelineRunner).
+        serial: True iff this stage will be run locally using bash instead of on the queue (Set by PipelineRunner).
+        executor: Executor (e.g. LocalExecutor or QueueSubmitter) which runs or submits this stage's 
+            script together with those of other stages, or None to run or submit it immediately in 
+            _run_script() (Set by PipelineRunner).
+        scheduler: Scheduler backend (e.g. SgeScheduler) used to submit this stage (Set by PipelineRunner).
+        parent_job: The grouped job (e.g. an ArrayJob) which this stage is submitted as part of, 
+            or None if it is submitted as its own job (Set by the executor).
         dry_run: Whether to just do a dry run which will skip the actual running of script in _run_script() (Set by PipelineRunner).
         root_dir: Path to root directory for this project (Set by PipelineRunner).
         setupenv: Path to setupenv.sh script for setting environment (Set by PipelineRunner).
         work_mem_megs: Megabytes required by this stage (Default provided by PipelineRunner). 
         threads: Number of threads used by this stage (Default provided by PipelineRunner).
         minutes: Number of minutes used by this stage (Default provided by PipelineRunner).
-        qsub_args: The SGE qsub arguments for running the job (Set by PipelineRunner).
-        qdel_script_file: Path to qdel script for this stage (Set by _run_stage when self.serial is True).
+        qsub_args: The scheduler's resource arguments for running the job (Set by PipelineRunner).
+        qdel_script_file: Path to qdel script for this stage (Set by the scheduler when self.serial is False).
+        script_file: Path to the experiment script for this stage (Set by _run_script).
+        stdout_path: Path to the stdout file for this stage (Set by _run_script).
+        tasks: The (first, last) array task ids to submit, or None for a single job.
+        script_prefix: Prefix for the names of this stage's qsub and qdel scripts.
+        priority: The job priority of this stage, from its critical path (Set by the QueueSubmitter).
         print_to_console: Whether to print stdout/stderr to the console (Set by PipelineRunner).
+        completion_resolver: CompletionResolver shared by the stages of one run (Set by PipelineRunner).
+        params_manifest: ParamsManifestWriter to which an ExpParams stage adds its parameters, or None 
+            (Set by PipelineRunner).
+        expparams_files: Whether an ExpParams stage also writes its parameters to expparams.txt when 
+            there is a params_manifest (Set by PipelineRunner).
+        stage_cache: StageCache in which this stage's outputs are stored, and from which they are
+            reused if it has already been run, or None (Set by PipelineRunner).
+        stage_hash: Content hash of this stage, or None if it is not cached (Set by _run_stage).
+        cacheable: Whether this stage's outputs may be reused from the stage_cache (or, in a 
+            rolling run, from its last run).
+        rolling: Whether this stage's directory may hold the outputs of an earlier run, which are
+            kept iff its inputs are unchanged (Set by PipelineRunner).
+        launched: Whether this stage's script has been run or submitted (Set by _run_script).
         
     Private attributes:
         prereqs: List of stages that should run before this stage.
         dependents: List of stages that should run after this stage.
         completion_indicator: Filename to be created upon successful completion.
+        graph_version: Counter shared by all stages which is incremented whenever any prereqs or
+            dependents are added, used to invalidate the topological order cached on a root stage.
     '''
     
+    graph_version = 0
+    
+    # Defaults for the attributes, which are only stored on a stage once they are set, 
+    # so that large sweeps of stages stay small.
+    completion_indicator = "DONE"
+    cwd = None
+    serial = False
+    executor = None
+    parent_job = None
+    scheduler = None
+    root_dir = None
+    setupenv = None
+    work_mem_megs = None
+    threads = None
+    minutes = None
+    qsub_args = None
+    qdel_script_file = None
+    script_file = None
+    stdout_path = None
+    tasks = None
+    script_prefix = ""
+    priority = None
+    print_to_console = None
+    completion_resolver = None
+    params_manifest = None
+    expparams_files = True
+    stage_cache = None
+    stage_hash = None
+    cacheable = True
+    rolling = False
+    launched = False
+    # The script from create_stage_script, if created by run_stage for a rolling run.
+    _stage_script = None
+    # A fixed random number to distinguish this task from
+    # other runs of this same task within qsub (drawn by get_qsub_name).
+    qsub_rand = None
+    
     def __init__(self, completion_indicator="DONE"):
         ''' If the default completion_indicator is used, it will be created in the cwd for this stage '''
-        self.completion_indicator = completion_indicator
+        if completion_indicator != Stage.completion_indicator:
+            self.completion_indicator = completion_indicator
         self.prereqs = []
         self.dependents = []
-        self.cwd = None
-        self.serial = False
-        self.root_dir = None
-        self.setupenv = None
-        self.work_mem_megs = None
-        self.threads = None
-        self.minutes = None
-        self.qsub_args = None
-        self.qdel_script_file = None
-        self.print_to_console = None
-        # A fixed random number to distinguish this task from
-        # other runs of this same task within qsub.
-        self.qsub_rand = random.randint(0, sys.maxint)
 
     def always_relaunch(self):
         # We add a non-canonical completion indicator in order to ensure
         # that this job will always relaunch.
         self.completion_indicator = "DONE_BUT_RELAUNCH"
+        self.cacheable = False
         
     def add_dependent(self, stage):
         stage.prereqs.append(self)
         self.dependents.append(stage)
+        Stage.graph_version += 1
     
     def add_dependents(self, stages):
         for stage in stages:
@@ -148,6 +246,7 @@ class Stage:
     def add_prereq(self, stage):
         self.prereqs.append(stage)
         stage.dependents.append(self)
+        Stage.graph_version += 1
 
     def add_prereqs(self, stages):
         for stage in stages:
@@ -156,18 +255,43 @@ class Stage:
     def get_qsub_name(self):
         '''Gets the SGE job name.'''
         # Create a more unique name for qsub so that multiple the kill script only kills its own job
+        if self.qsub_rand is None:
+            self.qsub_rand = random.randint(0, sys.maxint)
         qsub_name = "%s_%x" % (self.get_name(), self.qsub_rand)
         # If qsub name does not begin with a letter, add an "a"
         matcher = re.compile('^[a-z,A-Z]').search(qsub_name)
         if not matcher:
             qsub_name = 'a'+qsub_name
         return qsub_name
+    
+    def get_hold_name(self):
+        '''Gets the SGE job name that dependents of this stage should hold on.'''
+        if self.parent_job is not None:
+            return self.parent_job.get_qsub_name()
+        return self.get_qsub_name()
+    
+    def get_prereq_hold_names(self):
+        '''Gets the distinct SGE job names that this stage should hold on.'''
+        hold_names = []
+        for prereq in self.prereqs:
+            if not prereq.launched:
+                # E.g. the root stage, or a completed or cached stage, which is not submitted.
+                continue
+            hold_name = prereq.get_hold_name()
+            if hold_name not in hold_names:
+                hold_names.append(hold_name)
+        return hold_names
             
     def run_stage(self, exp_dir):
         self.exp_dir = exp_dir
         os.chdir(exp_dir)
+        if self.rolling:
+            # The stage's hash is needed to check whether its last run is still valid.
+            self._stage_script = self.create_stage_script(exp_dir)
+            self.stage_hash = get_stage_hash(self, self._stage_script, exp_dir)
         if self._is_already_completed():
             print "Skipping completed stage: name=" + self.get_name() + " completion_indicator=" + self.completion_indicator
+            self._stage_script = None
             return
         self._run_stage(exp_dir)
         
@@ -186,31 +310,71 @@ class Stage:
         # Source the setupenv.sh script.
         script += "source %s\n\n" % (self.setupenv)
         # Add the execution.
-        script += self.create_stage_script(exp_dir)
+        stage_script = self._stage_script
+        if stage_script is None:
+            stage_script = self.create_stage_script(exp_dir)
+            if self.stage_cache is not None:
+                self.stage_hash = get_stage_hash(self, stage_script, exp_dir)
+        self._stage_script = None
+        script += stage_script
         # Touch a file to indicate successful completion.
         script += "\ntouch '%s'\n" % (self.completion_indicator)        
+        was_run = False
+        if self.rolling:
+            was_run = self._forget_last_run(exp_dir)
+        if self.stage_cache is not None and self.stage_hash is not None:
+            # Files from an earlier run in this directory would be kept by link(), so
+            # the stage is rerun instead.
+            if not was_run and self.stage_cache.link(self.stage_hash, exp_dir, self.completion_indicator):
+                print "Reusing cached stage: name=" + self.get_name() + " hash=" + self.stage_hash
+                return
+            script += self.stage_cache.get_store_script(self.stage_hash)
         script_file = write_script("experiment-script", script, exp_dir)
         self._run_script(script_file, exp_dir)
 
+    def _forget_last_run(self, exp_dir):
+        '''For a rolling run: removes the completion indicator of the last run of this stage
+        (if any), and records the hash of the inputs of this run. Returns whether the stage 
+        was run before in this directory.
+
+        If the last run was reused from the stage cache, the files linked from the cache
+        entry are removed (see unlink_entry).'''
+        was_run = unlink_entry(exp_dir)
+        for name in [self.completion_indicator, STAGE_HASH_FILE]:
+            path = os.path.join(exp_dir, name)
+            if os.path.lexists(path):
+                os.remove(path)
+                was_run = True
+        if self.stage_hash is not None and not self.dry_run:
+            out = open(os.path.join(exp_dir, STAGE_HASH_FILE), 'w')
+            out.write(self.stage_hash + "\n")
+            out.close()
+        return was_run
+
     def __str__(self):
         return self.get_name()
 
     def _is_already_completed(self):
-        if not os.path.exists(self.completion_indicator):
-            return False
-        for prereq in self.prereqs:
-            if not prereq._is_already_completed():
-                return False
-        return True
+        resolver = self.completion_resolver
+        if resolver is None:
+            resolver = CompletionResolver()
+        return resolver.is_completed(self)
 
     def _run_script(self, script_file, cwd, stdout_filename="stdout"):
         stdout_path = os.path.join(cwd, stdout_filename)
+        self.script_file = script_file
+        self.stdout_path = stdout_path
+        self.launched = True
         os.chdir(cwd)
         assert(os.path.exists(script_file))
         if self.serial:
             command = "bash %s" % (script_file)
             print self.get_name(),":",command
             if self.dry_run: return
+            if self.executor is not None:
+                # Defer to the executor, which will run this script once the prereqs are done.
+                self.executor.add(self, script_file, cwd, stdout_path)
+                return
             stdout = open(stdout_path, 'w')
             if not self.print_to_console:
                 # Print stdout only to a file.
@@ -234,17 +398,14 @@ class Stage:
                 raise subprocess.CalledProcessError(retcode, command)
             #Old way: subprocess.check_call(shlex.split(command))
         else:
-            prereq_names = [prereq.get_qsub_name() for prereq in self.prereqs]
-            qsub_script = ""
-            qsub_script += get_cd_to_bash_script_parent() + "\n"
-            qsub_cmd = create_queue_command(script_file, cwd, self.get_qsub_name(), prereq_names, stdout_path, self.qsub_args)
-            qsub_script += qsub_cmd
-            qsub_script_file = write_script("qsub-script", qsub_script, cwd)
-            print qsub_cmd
-            if self.dry_run: return
-            subprocess.check_call(shlex.split("bash %s" % (qsub_script_file)))
-            qdel_script = "qdel %s" % (self.get_qsub_name())
-            self.qdel_script_file = write_script("qdel-script", qdel_script, cwd)
+            if self.executor is not None:
+                # Defer to the executor, which will submit this script with those of other stages.
+                self.executor.add(self, script_file, cwd, stdout_path)
+                return
+            scheduler = self.scheduler
+            if scheduler is None:
+                scheduler = SgeScheduler(self.dry_run)
+            scheduler.submit([self])
             
     def create_stage_script(self, exp_dir):
         ''' Override this method '''
@@ -277,6 +438,9 @@ class ScriptStringStage(NamedStage):
 
 class RootStage(NamedStage):
     
+    # A fixed hash for the stage cache, since the root stage is never run.
+    stage_hash = "root"
+    
     def __init__(self):
         NamedStage.__init__(self, "root_stage")
         
@@ -286,9 +450,48 @@ class RootStage(NamedStage):
 
 class PipelineRunner:
     
-    def __init__(self,name="experiments", queue=None, print_to_console=False, dry_run=False, rolling=False):
+    def __init__(self,name="experiments", queue=None, print_to_console=False, dry_run=False, rolling=False, 
+                 parallel=False, array_jobs=False, scheduler=None):
         self.name = name
         self.serial = (queue == None)
+        # Whether to run serial stages in parallel on the local machine, and the
+        # budget of threads and megabytes to use (None uses the whole machine).
+        self.parallel = parallel
+        self.max_local_threads = None
+        self.max_local_mem_megs = None
+        # Whether to submit sibling stages with the same qsub args and prereqs as array jobs.
+        self.array_jobs = array_jobs
+        # If not None, sibling stages with the same threads, work_mem_megs and prereqs are 
+        # packed into bundle jobs of up to this many minutes per lane, with bundle_lanes 
+        # lanes run in parallel (see BundleSubmitter).
+        self.bundle_minutes = None
+        self.bundle_lanes = 1
+        # Whether to fuse each linear chain of stages into a single job (see ChainSubmitter).
+        # Ignored if the stages are bundled.
+        self.fuse_chains = False
+        # Whether to submit the jobs on the queue with priorities from their critical paths 
+        # (see QueueSubmitter.set_priorities), so that the longest paths of stages start first.
+        self.queue_priorities = False
+        # Whether to print the predicted makespan of the pipeline, from the minutes of its 
+        # stages, before running it.
+        self.print_makespan = False
+        # The scheduler backend for the queue.
+        if scheduler is None:
+            scheduler = SgeScheduler()
+        self.scheduler = scheduler
+        self.executor = None
+        self.completion_resolver = None
+        # Whether to write the parameters of each stage to an expparams.txt file in its
+        # directory, as well as to the manifest of the exp tree (see manifest.py).
+        self.expparams_files = True
+        self.params_manifest = None
+        # The number of threads which create the stage directories, and the number of stages
+        # whose directories are created together, when the stages are not run immediately.
+        self.mkdir_threads = 16
+        self.mkdir_batch_size = 1000
+        # The StageCache from which the outputs of stages which were already run (e.g. 
+        # in an earlier exp tree) are reused, or None.
+        self.stage_cache = None
         self.root_dir = os.path.abspath(".")
         self.setupenv = os.path.abspath("./setupenv.sh")
         if not os.path.exists(self.setupenv):
@@ -308,34 +511,133 @@ class PipelineRunner:
         
     def run_pipeline(self, root_stage):
         self._check_stages(root_stage)
+        stages = self.get_stages_as_list(root_stage)
+        if self.print_makespan:
+            self._print_makespan(stages)
+        self._run_stages(stages)
+    
+    def _print_makespan(self, stages):
+        '''Prints the predicted makespan of the stages: the minutes of the critical path, or of 
+        all the stages if they are run one at a time. Stages which are already complete are 
+        counted, and the queue wait and the limits of the local machine are not.'''
+        stages = [stage for stage in stages if not isinstance(stage, RootStage)]
+        get_minutes = lambda stage: stage.minutes if stage.minutes is not None else self.minutes
+        if self.serial and not self.parallel:
+            print "Predicted makespan: %s (%d stages run serially)" % \
+                (get_mins_as_hrt_str(sum(map(get_minutes, stages))), len(stages))
+            return
+        levels = topological.get_bottom_levels(stages, get_minutes)
+        path = topological.get_critical_path(stages, levels)
+        makespan = levels[path[0]] if len(path) > 0 else 0
+        print "Predicted makespan: %s (critical path: %s)" % \
+            (get_mins_as_hrt_str(makespan), " -> ".join([str(stage.get_name()) for stage in path]))
+    
+    def _run_stages(self, stages):
+        '''Creates a directory for each stage and runs it, where stages is an iterable 
+        in which each stage comes after all of its prereqs. It is only iterated once.'''
+        timer = PhaseTimer()
+        timer.start("setup")
         top_dir = os.path.join(self.root_dir, "exp")
         if self.rolling:
+            # Reuse the directory of the last rolling run, if any (see CompletionResolver).
             exp_dir = os.path.join(top_dir, self.name)
-            os.system("rm -r %s" % (exp_dir))
-            # TODO: add support for rolling directories
+            _mkdir_if_missing(exp_dir)
         else:
             exp_dir = get_new_directory(prefix=self.name, dir=top_dir)
         os.chdir(exp_dir)
-        for stage in self.get_stages_as_list(root_stage):
-            if isinstance(stage, RootStage):
+        if self.serial and self.parallel:
+            self.executor = LocalExecutor(self.max_local_threads, self.max_local_mem_megs)
+        elif not self.serial:
+            self.scheduler.dry_run = self.dry_run
+            self.scheduler.priorities = self.queue_priorities
+            if self.bundle_minutes is not None:
+                self.executor = BundleSubmitter(self.scheduler, exp_dir, self.queue, self.bundle_minutes, self.bundle_lanes)
+            elif self.fuse_chains:
+                self.executor = ChainSubmitter(self.scheduler, exp_dir, self.queue)
+            elif self.array_jobs:
+                self.executor = ArrayJobSubmitter(self.scheduler, exp_dir)
+            else:
+                self.executor = QueueSubmitter(self.scheduler)
+        self.completion_resolver = CompletionResolver(check_hashes=self.rolling)
+        if self.stage_cache is not None:
+            timer.start("cache")
+            self.stage_cache.evict()
+            timer.start("setup")
+        self.params_manifest = ParamsManifestWriter(get_manifest_path(exp_dir))
+        run_stages = []
+        # Unless each stage is run as soon as it is created, create the directories of 
+        # a batch of stages at once, in parallel.
+        if self.executor is not None or self.dry_run:
+            batch_size = self.mkdir_batch_size
+            pool = ThreadPool(max(1, self.mkdir_threads))
+        else:
+            batch_size = 1
+            pool = None
+        stages = iter(stages)
+        try:
+            while True:
+                batch = list(itertools.islice(stages, batch_size))
+                if len(batch) == 0:
+                    break
+                batch = [stage for stage in batch if not isinstance(stage, RootStage)]
+                cwds = [os.path.join(exp_dir, str(stage.get_name())) for stage in batch]
+                timer.start("mkdir")
+                mkdir = _mkdir_if_missing if self.rolling else os.mkdir
+                if pool is not None:
+                    pool.map(mkdir, cwds)
+                else:
+                    map(mkdir, cwds)
+                timer.start("scripts")
+                for stage, cwd in zip(batch, cwds):
+                    self._update_stage(stage, cwd)
+                    stage.run_stage(cwd)
+                    run_stages.append(stage)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            # Close the manifest before any stages are run by the executor.
+            self.params_manifest.close()
+            self.params_manifest = None
+        try:
+            if self.executor is not None:
+                timer.start("run" if self.serial else "submit")
+                self.executor.run()
+        finally:
+            self.executor = None
+            if not self.serial:
+                # Even if the submission failed partway, so that the submitted jobs can be deleted.
+                timer.start("qdel")
+                self._write_global_qdel_script(run_stages, exp_dir)
+        self.completion_resolver = None
+        if self.stage_cache is not None:
+            print "Stage cache: %d hits, %d misses" % (self.stage_cache.num_hits, self.stage_cache.num_misses)
+        timer.stop()
+        print "Pipeline times:", timer
+    
+    def _write_global_qdel_script(self, run_stages, exp_dir):
+        '''Creates a global qdel script, which deletes the submitted jobs of the stages.'''
+        global_qdel = ""
+        qdel_script_files = set()
+        for stage in run_stages:
+            if stage.qdel_script_file is None or stage.qdel_script_file in qdel_script_files:
+                # Skip the stages which were not submitted, and those in the same array job.
                 continue
-            cwd = os.path.join(exp_dir, str(stage.get_name()))
-            os.mkdir(cwd)
-            self._update_stage(stage, cwd)
-            stage.run_stage(cwd)
-        if not self.serial:
-            # Create a global qdel script
-            global_qdel = ""
-            for stage in self.get_stages_as_list(root_stage):
-                if isinstance(stage, RootStage):
-                    continue
-                global_qdel += "bash %s\n" % (stage.qdel_script_file)
-            write_script("global-qdel-script", global_qdel, exp_dir)
+            qdel_script_files.add(stage.qdel_script_file)
+            global_qdel += "bash %s\n" % (stage.qdel_script_file)
+        write_script("global-qdel-script", global_qdel, exp_dir)
     
     def _update_stage(self, stage, cwd):
         '''Set some additional parameters on the stage.'''
         stage.cwd = cwd
         stage.serial = self.serial
+        stage.executor = self.executor
+        stage.scheduler = self.scheduler
+        stage.completion_resolver = self.completion_resolver
+        stage.params_manifest = self.params_manifest
+        stage.stage_cache = self.stage_cache
+        stage.rolling = self.rolling
+        stage.expparams_files = self.expparams_files
         stage.dry_run = self.dry_run
         stage.root_dir = self.root_dir
         stage.setupenv = self.setupenv
@@ -350,25 +652,30 @@ class PipelineRunner:
         if stage.print_to_console is None:
             stage.print_to_console = self.print_to_console
         # Get the stage's qsub args.
-        stage.qsub_args = get_qsub_args(self.queue, stage.threads, stage.work_mem_megs, stage.minutes)
+        stage.qsub_args = self.scheduler.get_resource_args(self.queue, stage.threads, stage.work_mem_megs, stage.minutes)
         
     def _check_stages(self, root_stage):
         all_stages = self.get_stages_as_list(root_stage)
+        all_names = [stage.get_name() for stage in all_stages]
         names = set()
-        for stage in all_stages:
-            if stage.get_name() in names:
-                print "ERROR: All stage names:\n" + "\n".join([s.get_name() for s in all_stages])
-                print "ERROR: Multiple stages have the same name: " + stage.get_name()
-                print "ERROR: Num copies:", len([x for x in all_stages if x.get_name() == stage.get_name()]) 
-                assert stage.get_name() not in names, "ERROR: Multiple stages have the same name: " + stage.get_name()
-            names.add(stage.get_name())
+        for name in all_names:
+            if name in names:
+                print "ERROR: All stage names:\n" + "\n".join(all_names)
+                print "ERROR: Multiple stages have the same name: " + name
+                print "ERROR: Num copies:", all_names.count(name)
+                assert name not in names, "ERROR: Multiple stages have the same name: " + name
+            names.add(name)
         print "All stages:"
-        for stage in all_stages: 
-            print "\t",stage.get_name()
+        for name in all_names: 
+            print "\t",name
         print "Number of stages:", len(all_stages)
             
     def get_stages_as_list(self, root_stage):
         return topological.bfs_topo_sort(root_stage)
         
+def _mkdir_if_missing(path):
+    if not os.path.isdir(path):
+        os.mkdir(path)
+
 if __name__ == '__main__':
     print "This script is not to be run directly"
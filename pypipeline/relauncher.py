@@ -14,44 +14,69 @@ from optparse import OptionParser
 import platform
 from glob import glob
 import shutil
+import time
+import random
+from multiprocessing.pool import ThreadPool
 from pypipeline.util import get_new_file, sweep_mult, fancify_cmd,\
     sweep_mult_low
 from pypipeline.pipeline import write_script, RootStage, Stage
+from pypipeline.scheduler import SgeScheduler, get_parent_job_name
 
 def run_and_get_output(command):
     p = Popen(args=shlex.split(command), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
     (stdoutdata, stderrdata) = p.communicate()
     return "\n".join([stdoutdata, stderrdata])
 
+job_name_re = re.compile(" -N (\S+) ")
+
 def get_job_name(qsub_file):
-    qsub_lines = open(qsub_file, 'r').readlines()
-    qsub_string = "".join(qsub_lines)
-    match = re.search(" -N (\S+) ", qsub_string)
+    qsub_string = open(qsub_file, 'r').read()
+    match = job_name_re.search(qsub_string)
     if match:
         return match.group(1)
     else:
         return None
 
-def is_running(job_name):
-    command = "qstat -j '%s'" % job_name
-    p = Popen(args=shlex.split(command), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    retcode = p.wait()
-    if (retcode == 0):
-        return True
-    else:
-        return False
+def get_job_names(qsub_file):
+    '''Gets the names of the jobs which may be running the experiment: the job submitted
+    by the qsub script, and the parent job which ran it with other experiments (e.g. a 
+    bundle job), if any.'''
+    names = [get_job_name(qsub_file), get_parent_job_name(open(qsub_file, 'r').read())]
+    return [name for name in names if name is not None]
+
+def is_running(job_name, scheduler=None):
+    '''Whether the job is queued or running.'''
+    if scheduler is None:
+        scheduler = SgeScheduler()
+    return scheduler.status([job_name])[job_name] is not None
 
 class Relauncher:
+    '''Relaunches the unfinished experiments in an experiment directory.
+
+    Jobs are resubmitted by up to workers threads at once. A failed submission is
+    retried up to tries times in total, sleeping between attempts for a random time
+    (full jitter) up to backoff_secs * 2^attempt, capped at max_backoff_secs, so that
+    many workers do not retry against the queue master in lockstep.
+    '''
 
-    def __init__(self, test, tries):
+    def __init__(self, test, tries, scheduler=None, workers=1, backoff_secs=1.0, max_backoff_secs=60.0):
         self.relaunch_count = 0
         self.running_count = 0
         self.done_count = 0
+        self.failed_count = 0
         self.test = test
         self.tries = tries
+        if scheduler is None:
+            scheduler = SgeScheduler()
+        self.scheduler = scheduler
+        self.workers = workers
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
 
     def relaunch(self, top_dir):
         top_dir = os.path.abspath(top_dir)
+        # Find the unfinished experiments and their job names.
+        unfinished = []
         for exp_dir in sorted(glob(os.path.join(top_dir, "*"))):
             qsub_file = os.path.join(exp_dir, "qsub-script_000.sh")
             
@@ -65,40 +90,74 @@ class Relauncher:
             if not os.path.exists(qsub_file):
                 print "WARN: experiment directory missing qsub script:", exp_dir
                 continue
-            # Check that the job is not already running
-            job_name = get_job_name(qsub_file)
-            if is_running(job_name):
-                print "Running: ", job_name
+            unfinished.append((exp_dir, qsub_file, get_job_names(qsub_file)))
+
+        # Get the states of all the jobs with a single query to the scheduler.
+        job_names = set()
+        for _, _, names in unfinished:
+            job_names.update(names)
+        job_states = self.scheduler.status(list(job_names))
+        to_relaunch = []
+        for exp_dir, qsub_file, names in unfinished:
+            # Check that the job (or its parent job) is not already running
+            running = [name for name in names if job_states.get(name) is not None]
+            if len(running) > 0:
+                print "Running: ", running[0]
                 self.running_count += 1
                 continue
+            to_relaunch.append((exp_dir, qsub_file))
 
-            self.relaunch_count += 1
-            if not self.test:
-                print "Removing stdout: "
-                # Remove stdout
-                os.system("rm -r %s" % (os.path.join(exp_dir, "stdout")))
-                # TODO: Remove state files
-                #os.system("rm -r %s" % (os.path.join(exp_dir, "state.binary.*")))
-                
-                # Relaunch
-                os.chdir(exp_dir)
+        if self.test:
+            for exp_dir, _ in to_relaunch:
                 print "Relaunching directory: ",exp_dir
-                cmd = "bash %s" % (qsub_file)
-                print cmd
-                for i in range(self.tries):
-                    if subprocess.call(shlex.split(cmd)) == 0:
-                        break
-                    elif i < self.tries-1:
-                        print "Failed to relaunch, trying again..."
+            self.relaunch_count += len(to_relaunch)
+        else:
+            # Relaunch, without changing the working directory so that jobs can be submitted concurrently.
+            pool = ThreadPool(max(1, self.workers))
+            try:
+                for exp_dir, tries in pool.imap(self._relaunch_dir, to_relaunch):
+                    if tries is None:
+                        print "Failed to relaunch directory: ",exp_dir
+                        self.failed_count += 1
                     else:
-                        raise Exception("Command returned non-zero exit code: " + cmd)
-            else:
-                print "Relaunching directory: ",exp_dir
+                        print "Relaunched directory: %s (tries=%d)" % (exp_dir, tries)
+                        self.relaunch_count += 1
+            finally:
+                pool.close()
+                pool.join()
 
-        print "Total: ",self.relaunch_count+self.done_count+self.running_count
+        print "Total: ",self.relaunch_count+self.done_count+self.running_count+self.failed_count
         print "Total done: ",self.done_count
         print "Total already running: ",self.running_count
         print "Total relaunched: ",self.relaunch_count
+        print "Total failed to relaunch: ",self.failed_count
+        if self.failed_count > 0:
+            raise Exception("Failed to relaunch %d experiments" % (self.failed_count))
+
+    def _relaunch_dir(self, exp_dir_and_qsub_file):
+        '''Relaunches a single experiment, retrying with backoff.
+
+        Returns a pair of the experiment directory and the number of tries it took
+        (or None if it failed every try).
+        '''
+        exp_dir, qsub_file = exp_dir_and_qsub_file
+        # Remove stdout
+        stdout_file = os.path.join(exp_dir, "stdout")
+        if os.path.exists(stdout_file):
+            os.remove(stdout_file)
+        # TODO: Remove state files
+        #os.system("rm -r %s" % (os.path.join(exp_dir, "state.binary.*")))
+
+        cmd = "bash %s" % (qsub_file)
+        for i in range(self.tries):
+            if subprocess.call(shlex.split(cmd), cwd=exp_dir) == 0:
+                return exp_dir, i + 1
+            if i < self.tries-1:
+                time.sleep(self._get_backoff_secs(i))
+        return exp_dir, None
+
+    def _get_backoff_secs(self, attempt):
+        return random.uniform(0, min(self.max_backoff_secs, self.backoff_secs * (2 ** attempt)))
 
     def cleanup_dir(self, exp_dir):
         ''' OVERRIDE THIS IN SUBCLASS'''
@@ -0,0 +1,523 @@
+'''
+Backends for submitting stages to a batch scheduler (SGE, SLURM, or a fake
+in-process scheduler for testing).
+
+A job passed to Scheduler.submit() is a Stage, or any object (e.g. a MultiStageJob)
+with the same submission attributes:
+    get_qsub_name(): The job name.
+    get_prereq_hold_names(): The job names that this job should hold on.
+    script_file: Path to the bash script to run.
+    cwd: Directory in which to write the qsub/qdel scripts and run the job.
+    stdout_path: Path to the stdout file.
+    qsub_args: The resource arguments from get_resource_args().
+    tasks: A (first, last) pair of array task ids, or None.
+    script_prefix: Prefix for the names of the qsub/qdel scripts.
+    priority: The length of the critical path from the job relative to the longest,
+        in [0, 1], or None (Set by QueueSubmitter).
+    qdel_script_file: Path to the qdel script (Set by submit).
+
+@author: mgormley
+'''
+
+import os
+import re
+import sys
+import time
+import random
+import tempfile
+import shlex
+import subprocess
+from subprocess import Popen
+from collections import OrderedDict
+from xml.etree import ElementTree
+# Imported as a module since pipeline imports this module.
+import pipeline
+from qsub import get_qsub_args, get_mins_as_hrt_str
+from topological import get_bottom_levels
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+def create_queue_command(script_file, cwd, name="test", prereqs=[], stdout="stdout", qsub_args=None, tasks=None,
+                         priority=None):
+    '''Creates the qsub command. If tasks is a (first, last) pair of task ids, the command
+    submits an array job with those tasks. If priority is not None, it is a job priority
+    in [0, 1] (see QueueSubmitter.set_priorities), which is mapped to a qsub priority in 
+    [-1023, 0].
+    '''
+    # Make the stdout file and script_file relative paths to cwd if possible.
+    if stdout != os.devnull:
+        stdout = os.path.relpath(stdout, cwd)
+    script_file = os.path.relpath(script_file, cwd)
+    # Create the qsub command.
+    queue_command = "qsub "
+    if qsub_args:
+        queue_command += " " + qsub_args + " "
+    else:
+        #queue_command += " -q cpu.q "
+        queue_command += " -q mem.q -q himem.q -l vf=15.5G "
+    queue_command += " -cwd -j y -b y -V -N %s -e stderr -o %s " % (name, stdout)
+    if tasks is not None:
+        queue_command += "-t %d-%d " % tasks
+    if priority is not None:
+        # Users may only lower the priority of their jobs below the default of 0.
+        queue_command += "-p %d " % (int(round(1023 * (priority - 1))))
+    if len(prereqs) > 0:
+        queue_command += "-hold_jid %s " % (",".join(prereqs))
+    queue_command += "\"bash '%s'\"" % (script_file)
+    return queue_command
+
+def get_relaunch_script(cmd, parent_job_name):
+    '''Gets the qsub script which relaunches a single stage of a job which runs several
+    stages (e.g. a BundleJob), given the submit command for the stage alone. The script
+    names the parent job in a comment (see get_parent_job_name), so that the Relauncher 
+    does not relaunch the stage while its parent job is queued or running.
+    '''
+    return pipeline.get_cd_to_bash_script_parent() + "\n# Parent job: %s\n%s" % (parent_job_name, cmd)
+
+_parent_job_re = re.compile(r"^# Parent job: (\S+)$", re.MULTILINE)
+
+def get_parent_job_name(qsub_script):
+    '''Gets the name of the parent job from a qsub script written by get_relaunch_script,
+    or None if it has none.'''
+    match = _parent_job_re.search(qsub_script)
+    if match:
+        return match.group(1)
+    return None
+
+def get_qstat_xml_states(qstat_xml):
+    '''Gets a dict mapping job names to QUEUED or RUNNING from the output of qstat -xml.'''
+    states = {}
+    if qstat_xml.strip() == "":
+        return states
+    for job in ElementTree.fromstring(qstat_xml).iter("job_list"):
+        name = job.findtext("JB_name")
+        if job.get("state") == "running":
+            states[name] = RUNNING
+        elif states.get(name) != RUNNING:
+            # An array job is running if any of its tasks are.
+            states[name] = QUEUED
+    return states
+
+def get_command_stdout(command):
+    p = Popen(args=shlex.split(command), stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    (stdoutdata, _) = p.communicate()
+    return stdoutdata
+
+class Scheduler:
+    '''A batch scheduler backend.
+
+    Subclasses implement get_resource_args(), get_submit_command(), get_cancel_command()
+    and status(), and either _run_submit_script() or submit().
+
+    Attributes:
+        task_id_var: Environment variable holding the task id of an array job.
+        dry_run: Whether to write the qsub scripts without running them.
+        priorities: Whether to submit jobs with their priorities, if the scheduler
+            supports them.
+    '''
+
+    task_id_var = None
+    priorities = False
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+
+    def get_resource_args(self, queue, threads, work_mem_megs, minutes):
+        '''OVERRIDE THIS METHOD: gets the arguments requesting resources for a job.'''
+        raise NotImplementedError()
+
+    def get_submit_command(self, script_file, cwd, name, hold_names, stdout, args, tasks=None, priority=None):
+        '''OVERRIDE THIS METHOD: gets the shell command which submits a job, with the given 
+        priority (see QueueSubmitter.set_priorities) if it is not None and the scheduler 
+        supports priorities.'''
+        raise NotImplementedError()
+
+    def get_cancel_command(self, job_ids):
+        '''OVERRIDE THIS METHOD: gets the shell command which cancels the given jobs.'''
+        raise NotImplementedError()
+
+    def submit(self, jobs):
+        '''Submits the jobs, which must be in topological order, and returns their job ids.
+
+        For each job, this writes a qsub script (which can be rerun to relaunch the
+        job) and after submission a qdel script.
+        '''
+        job_ids = []
+        for job in jobs:
+            qsub_script_file = self._write_submit_script(job)
+            if self.dry_run: continue
+            job_id = self._run_submit_script(job, qsub_script_file)
+            self._write_cancel_script(job, job_id)
+            job_ids.append(job_id)
+        return job_ids
+
+    def status(self, job_ids):
+        '''OVERRIDE THIS METHOD: gets a dict mapping each of the given job ids to QUEUED 
+        or RUNNING, or None if the scheduler does not know of the job (e.g. it has finished).
+        '''
+        raise NotImplementedError()
+
+    def cancel(self, job_ids):
+        '''Cancels the given jobs.'''
+        if len(job_ids) == 0 or self.dry_run:
+            return
+        subprocess.check_call(shlex.split(self.get_cancel_command(job_ids)))
+
+    def _write_submit_script(self, job):
+        priority = getattr(job, "priority", None) if self.priorities else None
+        cmd = self.get_submit_command(job.script_file, job.cwd, job.get_qsub_name(), job.get_prereq_hold_names(),
+                                      job.stdout_path, job.qsub_args, job.tasks, priority)
+        script = pipeline.get_cd_to_bash_script_parent() + "\n" + cmd
+        print cmd
+        return pipeline.write_script(job.script_prefix + "qsub-script", script, job.cwd)
+
+    def _write_cancel_script(self, job, job_id):
+        cmd = self.get_cancel_command([job_id])
+        job.qdel_script_file = pipeline.write_script(job.script_prefix + "qdel-script", cmd, job.cwd)
+
+    def _run_submit_script(self, job, qsub_script_file):
+        '''OVERRIDE THIS METHOD (unless submit() is overridden): runs the qsub script for a 
+        job and returns its job id.'''
+        raise NotImplementedError()
+
+# The marker printed after each job is submitted by SgeScheduler.submit().
+_SUBMITTED_MARKER = "pypipeline-submitted-job "
+
+class SgeScheduler(Scheduler):
+    '''Sun Grid Engine. Job ids are the job names, which dependents hold on with -hold_jid.'''
+
+    task_id_var = "SGE_TASK_ID"
+
+    def get_resource_args(self, queue, threads, work_mem_megs, minutes):
+        return get_qsub_args(queue, threads, work_mem_megs, minutes)
+
+    def get_submit_command(self, script_file, cwd, name, hold_names, stdout, args, tasks=None, priority=None):
+        return create_queue_command(script_file, cwd, name, hold_names, stdout, args, tasks, priority)
+
+    def get_cancel_command(self, job_ids):
+        return "qdel %s" % (",".join(job_ids))
+
+    def submit(self, jobs):
+        '''Overriding method for Scheduler: runs all the qsub scripts from a single bash process.
+
+        After each qsub, the bash process prints a marker line, so that the qdel script of
+        each job is written as soon as it is submitted, even if a later qsub fails.
+        '''
+        qsub_script_files = [self._write_submit_script(job) for job in jobs]
+        if self.dry_run or len(jobs) == 0:
+            return []
+        # The commands are read from a file rather than a pipe, so that bash cannot block 
+        # on writing its output while we are still writing its input.
+        commands = tempfile.TemporaryFile()
+        for i, f in enumerate(qsub_script_files):
+            commands.write("bash '%s'\necho '%s%d'\n" % (f, _SUBMITTED_MARKER, i))
+        commands.seek(0)
+        p = Popen(args=["bash", "-e"], stdin=commands, stdout=subprocess.PIPE)
+        commands.close()
+        job_ids = []
+        for line in iter(p.stdout.readline, ''):
+            if line.startswith(_SUBMITTED_MARKER):
+                job = jobs[int(line[len(_SUBMITTED_MARKER):])]
+                self._write_cancel_script(job, job.get_qsub_name())
+                job_ids.append(job.get_qsub_name())
+            else:
+                sys.stdout.write(line)
+        p.stdout.close()
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, "bash %s" % (qsub_script_files[len(job_ids)]))
+        return job_ids
+
+    def status(self, job_ids):
+        '''Overriding method for Scheduler: gets all the jobs with a single call to qstat.'''
+        states = get_qstat_xml_states(self.get_qstat_xml())
+        return dict((job_id, states.get(job_id)) for job_id in job_ids)
+
+    def get_qstat_xml(self):
+        '''Gets the output of qstat -xml listing all of this user's jobs.'''
+        return get_command_stdout("qstat -xml")
+
+class SlurmScheduler(Scheduler):
+    '''SLURM. Job ids are the numeric ids assigned by sbatch. Holds on the names of jobs
+    submitted by this scheduler are converted to afterok dependencies on their ids.
+    '''
+
+    task_id_var = "SLURM_ARRAY_TASK_ID"
+
+    def __init__(self, dry_run=False, partition=None):
+        Scheduler.__init__(self, dry_run)
+        self.partition = partition
+        self.name_to_id = {}
+
+    def get_resource_args(self, queue, threads, work_mem_megs, minutes):
+        args = " --cpus-per-task=%d --mem=%dM --time=%s " % (threads, work_mem_megs, get_mins_as_hrt_str(minutes))
+        if self.partition is not None:
+            args += " --partition=%s " % (self.partition)
+        return args
+
+    def get_submit_command(self, script_file, cwd, name, hold_names, stdout, args, tasks=None, priority=None):
+        if stdout != os.devnull:
+            stdout = os.path.relpath(stdout, cwd)
+        script_file = os.path.relpath(script_file, cwd)
+        command = "sbatch --parsable "
+        if args:
+            command += " " + args + " "
+        command += " -J %s -o %s " % (name, stdout)
+        if tasks is not None:
+            command += "--array=%d-%d " % tasks
+        if priority is not None:
+            # Users may only lower the priority of their jobs, by raising their nice value.
+            command += "--nice=%d " % (int(round(1023 * (1 - priority))))
+        hold_ids = [self.name_to_id[n] for n in hold_names if n in self.name_to_id]
+        if len(hold_ids) > 0:
+            command += "--dependency=afterok:%s " % (":".join(hold_ids))
+        command += "--wrap \"bash '%s'\"" % (script_file)
+        return command
+
+    def get_cancel_command(self, job_ids):
+        return "scancel %s" % (" ".join(job_ids))
+
+    def _run_submit_script(self, job, qsub_script_file):
+        output = subprocess.check_output(["bash", qsub_script_file])
+        # The job id is printed on the last line as "jobid" or "jobid;cluster".
+        job_id = output.strip().split("\n")[-1].split(";")[0]
+        self.name_to_id[job.get_qsub_name()] = job_id
+        return job_id
+
+    def status(self, job_ids):
+        '''Overriding method for Scheduler: matches either the ids or the names of jobs.'''
+        states = {}
+        for line in get_command_stdout("squeue -h -o '%i %j %T'").split("\n"):
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            # Array tasks have ids of the form jobid_taskid.
+            job_id, name, state = fields[0].split("_")[0], fields[1], fields[2]
+            state = RUNNING if state in ("RUNNING", "COMPLETING") else QUEUED
+            for key in (job_id, name):
+                if states.get(key) != RUNNING:
+                    states[key] = state
+        return dict((job_id, states.get(job_id)) for job_id in job_ids)
+
+class FakeJob:
+    '''A job submitted to the FakeScheduler.'''
+
+    def __init__(self, job_id, job, hold_names):
+        self.job_id = job_id
+        self.hold_names = hold_names
+        self.script_file = job.script_file
+        self.cwd = job.cwd
+        self.stdout_path = job.stdout_path
+        self.tasks = job.tasks
+        self.state = QUEUED
+
+class FakeScheduler(Scheduler):
+    '''An in-process scheduler which simulates a queue, for measuring submission
+    throughput and testing hold dependencies without a cluster.
+
+    Each call to submit() sleeps for latency_secs plus job_latency_secs per job, to
+    simulate the round trips to the queue master. Submitted jobs stay QUEUED until
+    run_jobs() is called, which runs them (or, if execute is False, just marks them
+    DONE) in an order respecting their holds. As on SGE, holds on unknown job names
+    are ignored, but they are recorded in unknown_holds.
+    '''
+
+    task_id_var = "SGE_TASK_ID"
+
+    def __init__(self, dry_run=False, latency_secs=0.0, job_latency_secs=0.0, execute=False):
+        Scheduler.__init__(self, dry_run)
+        self.latency_secs = latency_secs
+        self.job_latency_secs = job_latency_secs
+        self.execute = execute
+        self.jobs = OrderedDict() # Map from job id to FakeJob, in submission order.
+        self.unknown_holds = [] # List of (job id, hold name) pairs.
+        self.num_submit_calls = 0
+
+    def get_resource_args(self, queue, threads, work_mem_megs, minutes):
+        return get_qsub_args(queue, threads, work_mem_megs, minutes)
+
+    def get_submit_command(self, script_file, cwd, name, hold_names, stdout, args, tasks=None, priority=None):
+        return "fake-" + create_queue_command(script_file, cwd, name, hold_names, stdout, args, tasks, priority)
+
+    def get_cancel_command(self, job_ids):
+        return "fake-qdel %s" % (",".join(job_ids))
+
+    def submit(self, jobs):
+        '''Overriding method for Scheduler.'''
+        self.num_submit_calls += 1
+        time.sleep(self.latency_secs + self.job_latency_secs * len(jobs))
+        return Scheduler.submit(self, jobs)
+
+    def _run_submit_script(self, job, qsub_script_file):
+        job_id = job.get_qsub_name()
+        hold_names = []
+        for hold_name in job.get_prereq_hold_names():
+            if hold_name not in self.jobs:
+                # As on SGE, the hold is dropped even if the job is submitted later.
+                self.unknown_holds.append((job_id, hold_name))
+            else:
+                hold_names.append(hold_name)
+        self.jobs[job_id] = FakeJob(job_id, job, hold_names)
+        return job_id
+
+    def status(self, job_ids):
+        '''Overriding method for Scheduler: parses the output of the fake qstat.'''
+        states = get_qstat_xml_states(self.get_qstat_xml())
+        return dict((job_id, states.get(job_id)) for job_id in job_ids)
+
+    def get_qstat_xml(self):
+        '''A fake qstat: gets the queued and running jobs in the format of qstat -xml.'''
+        queue_info = ElementTree.Element("queue_info")
+        job_info = ElementTree.Element("job_info")
+        for i, job in enumerate(self.jobs.values()):
+            if job.state == RUNNING:
+                parent, state, sge_state = queue_info, "running", "r"
+            elif job.state == QUEUED:
+                parent, state, sge_state = job_info, "pending", "qw"
+            else:
+                continue
+            job_list = ElementTree.SubElement(parent, "job_list", state=state)
+            ElementTree.SubElement(job_list, "JB_job_number").text = str(i + 1)
+            ElementTree.SubElement(job_list, "JB_name").text = job.job_id
+            ElementTree.SubElement(job_list, "state").text = sge_state
+        root = ElementTree.Element("job_info")
+        root.append(queue_info)
+        root.append(job_info)
+        return ElementTree.tostring(root)
+
+    def cancel(self, job_ids):
+        '''Overriding method for Scheduler.'''
+        for job_id in job_ids:
+            self.jobs.pop(job_id, None)
+
+    def run_jobs(self):
+        '''Runs all the queued jobs once the jobs they hold on have finished.'''
+        while True:
+            ready = [job for job in self.jobs.values() if job.state == QUEUED and self._is_released(job)]
+            if len(ready) == 0:
+                break
+            for job in ready:
+                job.state = RUNNING
+                job.state = self._run_job(job)
+        held = [job.job_id for job in self.jobs.values() if job.state == QUEUED]
+        if len(held) > 0:
+            raise Exception("Jobs held on jobs that never finish: " + " ".join(held))
+
+    def _is_released(self, job):
+        # As with -hold_jid on SGE, a job is released when the jobs it holds on
+        # have finished, whether or not they succeeded.
+        for hold_name in job.hold_names:
+            hold = self.jobs.get(hold_name)
+            if hold is not None and hold.state in (QUEUED, RUNNING):
+                return False
+        return True
+
+    def _run_job(self, job):
+        if not self.execute:
+            return DONE
+        first, last = job.tasks if job.tasks is not None else (None, None)
+        state = DONE
+        for task_id in (range(first, last + 1) if first is not None else [None]):
+            env = dict(os.environ)
+            if task_id is not None:
+                env[self.task_id_var] = str(task_id)
+            stdout = open(job.stdout_path, 'a')
+            retcode = subprocess.call(["bash", job.script_file], cwd=job.cwd, env=env,
+                                      stdout=stdout, stderr=subprocess.STDOUT)
+            stdout.close()
+            if retcode != 0:
+                state = FAILED
+        return state
+
+class QueueSubmitter:
+    '''Collects the stages of a pipeline which are to be run on the queue, and
+    submits them all with a single call to Scheduler.submit().
+    '''
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.stages = [] # List of stages in the order added.
+
+    def add(self, stage, script_file, cwd, stdout_path):
+        '''Adds a stage to be submitted. The prereqs of a stage must be added before it.'''
+        self.stages.append(stage)
+
+    def run(self):
+        '''Submits all the added stages.'''
+        jobs = self.get_jobs()
+        self.set_priorities(jobs)
+        self.scheduler.submit(jobs)
+
+    def get_jobs(self):
+        '''Gets the jobs to submit for the added stages, in topological order.'''
+        return list(self.stages)
+
+    def set_priorities(self, jobs):
+        '''Sets the priority attribute of each job from the longest path of minutes
+        from its stages to the end of the pipeline (see get_bottom_levels), relative to
+        the longest such path. Jobs on the critical path get a priority of 1.'''
+        levels = get_bottom_levels(self.stages, lambda stage: stage.minutes or 0)
+        job_levels = [max([levels[s] for s in getattr(job, "stages", [job])]) for job in jobs]
+        max_level = max(job_levels) if len(job_levels) > 0 else 0
+        for job, level in zip(jobs, job_levels):
+            job.priority = float(level) / max_level if max_level > 0 else 1.0
+
+class MultiStageJob:
+    '''A single job which runs the scripts of several stages (e.g. an ArrayJob), with the
+    submission attributes listed above. It is named after its first stage, and it holds
+    on the prereqs of its first stage.
+    '''
+
+    def __init__(self, kind, stages, exp_dir):
+        self.kind = kind
+        self.stages = stages
+        self.cwd = exp_dir
+        self.stdout_path = os.devnull # Each stage writes its own stdout file.
+        self.qsub_args = None
+        self.tasks = None
+        self.script_prefix = kind + "-"
+        self.script_file = None
+        self.qdel_script_file = None
+        self.priority = None
+        self.qsub_rand = random.randint(0, sys.maxint)
+
+    def get_qsub_name(self):
+        return "%s_%s_%x" % (self.kind, self.stages[0].get_qsub_name(), self.qsub_rand)
+
+    def get_prereq_hold_names(self):
+        return self.stages[0].get_prereq_hold_names()
+
+    def _write_script(self, script):
+        '''Writes the script which runs the stages, and sets script_file.'''
+        self.script_file = pipeline.write_script(self.kind + "-script", script, self.cwd)
+
+class MultiStageSubmitter(QueueSubmitter):
+    '''A QueueSubmitter whose get_jobs() may group stages into MultiStageJobs.
+
+    Dependents hold on the whole job, and all the stages in a job share its qdel script.
+    Each stage of a job still gets its own qsub script, which resubmits only that stage
+    (e.g. for the Relauncher, which skips it while the job is queued or running), but
+    it is not run here.
+    '''
+
+    def run(self):
+        '''Overriding method for QueueSubmitter.'''
+        jobs = self.get_jobs()
+        self.set_priorities(jobs)
+        self.scheduler.submit(jobs)
+        for job in jobs:
+            if not isinstance(job, MultiStageJob):
+                continue
+            for i, stage in enumerate(job.stages):
+                cmd = self.get_stage_submit_command(job, i)
+                pipeline.write_script("qsub-script", get_relaunch_script(cmd, job.get_qsub_name()), stage.cwd)
+                stage.qdel_script_file = job.qdel_script_file
+
+    def get_stage_submit_command(self, job, i):
+        '''Gets the command which resubmits only the i'th stage of the job. By default,
+        the stage is submitted alone and holds on the prereqs of the job.'''
+        stage = job.stages[i]
+        return self.scheduler.get_submit_command(stage.script_file, stage.cwd, stage.get_qsub_name(),
+                                                 job.get_prereq_hold_names(), stage.stdout_path, stage.qsub_args)
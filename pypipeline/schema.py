@@ -0,0 +1,234 @@
+'''
+Compact storage for the parameters of ExpParams.
+
+@author: mgormley
+'''
+
+from itertools import izip
+from UserDict import DictMixin
+
+class Schema:
+    '''The keys and excluded keys of a set of parameters, shared by many ExpParams.
+
+    Each ExpParams only stores a list of its values, in the order of the keys of
+    its schema. A schema is immutable: changing the keys or excluded keys of an
+    ExpParams replaces its schema with a derived one. The derived schemas are
+    cached, so ExpParams built by the same sequence of changes (e.g. all the
+    points of a sweep) share the same schemas.
+
+    Attributes:
+        keys: Tuple of the keys.
+        index: Dict mapping each key to its position in keys.
+        exclude_name_keys: Frozenset of the keys excluded from the name.
+        exclude_arg_keys: Frozenset of the keys excluded from the arguments.
+    '''
+
+    def __init__(self, keys=(), exclude_name_keys=frozenset(), exclude_arg_keys=frozenset()):
+        self.keys = tuple(keys)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+        self.exclude_name_keys = frozenset(exclude_name_keys)
+        self.exclude_arg_keys = frozenset(exclude_arg_keys)
+        self._derived = {}
+        self._concats = {} # Map from id(other) to (other, schema, positions) for concat().
+
+    def __getstate__(self):
+        # The cache of derived schemas is not pickled.
+        return (self.keys, self.exclude_name_keys, self.exclude_arg_keys)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def get_name_key_order(self, initial_keys):
+        '''Gets a tuple of the initial keys which are in this schema, followed by the other keys 
+        in sorted order (see ExpParams.get_name_key_order).'''
+        initial_keys = tuple(initial_keys)
+        key_order = self._derived.get(("name_key_order", initial_keys))
+        if key_order is None:
+            initial_set = set(initial_keys)
+            key_order = tuple([k for k in initial_keys if k in self.index] + 
+                              [k for k in sorted(self.keys) if k not in initial_set])
+            self._derived[("name_key_order", initial_keys)] = key_order
+        return key_order
+
+    def with_key(self, key):
+        '''Gets the schema with key appended to the keys.'''
+        derived = self._derived.get(("key", key))
+        if derived is None:
+            derived = Schema(self.keys + (key,), self.exclude_name_keys, self.exclude_arg_keys)
+            self._derived[("key", key)] = derived
+        return derived
+
+    def without_key(self, key):
+        '''Gets the schema without key in the keys (the excluded keys are unchanged).'''
+        derived = self._derived.get(("del", key))
+        if derived is None:
+            derived = Schema([k for k in self.keys if k != key], self.exclude_name_keys, self.exclude_arg_keys)
+            self._derived[("del", key)] = derived
+        return derived
+
+    def with_excluded(self, kind, key, excluded):
+        '''Gets the schema with key added to (or removed from, if excluded is False) the
+        excluded keys of the given kind: "name" or "arg".'''
+        keys = self.exclude_name_keys if kind == "name" else self.exclude_arg_keys
+        if (key in keys) == excluded:
+            return self
+        derived = self._derived.get((kind, key, excluded))
+        if derived is None:
+            keys = keys.union([key]) if excluded else keys.difference([key])
+            if kind == "name":
+                derived = Schema(self.keys, keys, self.exclude_arg_keys)
+            else:
+                derived = Schema(self.keys, self.exclude_name_keys, keys)
+            self._derived[(kind, key, excluded)] = derived
+        return derived
+
+    def concat(self, other):
+        '''Gets the schema with the keys of self followed by the new keys of other, and the
+        union of their excluded keys. Returns a pair of that schema and a tuple of the position
+        in it of each of other's keys.'''
+        # Keyed by id, which is faster to hash. The cached other keeps its id from being reused.
+        derived = self._concats.get(id(other))
+        if derived is None:
+            if len(self.keys) == 0 and len(self.exclude_name_keys) == 0 and len(self.exclude_arg_keys) == 0:
+                schema = other
+            else:
+                schema = Schema(self.keys + tuple([k for k in other.keys if k not in self.index]),
+                                self.exclude_name_keys | other.exclude_name_keys,
+                                self.exclude_arg_keys | other.exclude_arg_keys)
+            derived = (other, schema, tuple([schema.index[k] for k in other.keys]))
+            self._concats[id(other)] = derived
+        return derived[1], derived[2]
+
+# The schema of an ExpParams without any parameters.
+EMPTY_SCHEMA = Schema()
+
+class ParamsView(DictMixin):
+    '''A dict-like view of the parameters of an ExpParams, through which they can be
+    read and modified.'''
+
+    def __init__(self, exp):
+        self.exp = exp
+
+    def __getitem__(self, key):
+        return self.exp._values[self.exp._schema.index[key]]
+
+    def __setitem__(self, key, value):
+        self.exp._set_value(key, value)
+
+    def __delitem__(self, key):
+        if key not in self.exp._schema.index:
+            raise KeyError(key)
+        self.exp.remove(key)
+
+    def __contains__(self, key):
+        return key in self.exp._schema.index
+
+    def __iter__(self):
+        return iter(self.exp._schema.keys)
+
+    def __len__(self):
+        return len(self.exp._values)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def has_key(self, key):
+        return key in self.exp._schema.index
+
+    def get(self, key, default=None):
+        i = self.exp._schema.index.get(key)
+        if i is None:
+            return default
+        return self.exp._values[i]
+
+    def keys(self):
+        return list(self.exp._schema.keys)
+
+    def values(self):
+        return list(self.exp._values)
+
+    def items(self):
+        return zip(self.exp._schema.keys, self.exp._values)
+
+    def iteritems(self):
+        return izip(self.exp._schema.keys, self.exp._values)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+class ExcludedKeysView:
+    '''A set-like view of the keys of an ExpParams which are excluded from its name
+    (kind="name") or arguments (kind="arg"), through which they can be read and modified.'''
+
+    def __init__(self, exp, kind):
+        self.exp = exp
+        self.kind = kind
+
+    def _get_keys(self):
+        if self.kind == "name":
+            return self.exp._schema.exclude_name_keys
+        return self.exp._schema.exclude_arg_keys
+
+    def __contains__(self, key):
+        return key in self._get_keys()
+
+    def __iter__(self):
+        return iter(self._get_keys())
+
+    def __len__(self):
+        return len(self._get_keys())
+
+    def __repr__(self):
+        return repr(set(self._get_keys()))
+
+    def __eq__(self, other):
+        return set(self._get_keys()) == set(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __or__(self, other):
+        return set(self._get_keys()) | set(other)
+
+    def __and__(self, other):
+        return set(self._get_keys()) & set(other)
+
+    def __sub__(self, other):
+        return set(self._get_keys()) - set(other)
+
+    def __rsub__(self, other):
+        return set(other) - set(self._get_keys())
+
+    def union(self, *others):
+        return set(self._get_keys()).union(*others)
+
+    def intersection(self, *others):
+        return set(self._get_keys()).intersection(*others)
+
+    def difference(self, *others):
+        return set(self._get_keys()).difference(*others)
+
+    def copy(self):
+        return set(self._get_keys())
+
+    def add(self, key):
+        self._set_excluded(key, True)
+
+    def discard(self, key):
+        self._set_excluded(key, False)
+
+    def _set_excluded(self, key, excluded):
+        if self.kind == "name":
+            self.exp.set_incl_name(key, not excluded)
+        else:
+            self.exp.set_incl_arg(key, not excluded)
+
+    def remove(self, key):
+        if key not in self._get_keys():
+            raise KeyError(key)
+        self.discard(key)
+
+    def update(self, *others):
+        for keys in others:
+            for key in keys:
+                self.add(key)
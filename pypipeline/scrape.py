@@ -11,10 +11,18 @@ import subprocess
 from optparse import OptionParser
 from glob import glob
 import getpass
+import traceback
+import multiprocessing
+import cPickle
+import sqlite3
+import heapq
+from collections import defaultdict
 from pypipeline.util import get_all_following, get_following, get_time,\
-    to_str, get_following_literal, tail, get_group1
-from pypipeline.experiment_runner import get_nonunique_keys,\
+    to_str, get_following_literal, tail, get_group1, LogExtractor, LAST
+from pypipeline.experiment_runner import get_nonunique_keys, _add_nonunique_keys,\
     get_exclude_name_keys, get_all_keys, ExpParams
+from pypipeline.manifest import get_manifest_path, read_manifest_lines,\
+    parse_manifest_line
 
 class ResultsWriter:
     
@@ -29,13 +37,20 @@ class ResultsWriter:
     
     def write_error(self, exp_dir):
         pass
+    
+    def write_nonunique_keys(self, keys):
+        pass
             
     def write_results(self, key_order, values_list, get_as_str):
         pass
     
     def get_all_as_strs(self, key_order, values_list, get_as_str):
         key_order = map(get_as_str, key_order)
-        values_list = [map(get_as_str, values) for values in values_list]
+        if isinstance(values_list, list):
+            values_list = [map(get_as_str, values) for values in values_list]
+        else:
+            # Convert the rows lazily when streaming.
+            values_list = (map(get_as_str, values) for values in values_list)
         return key_order, values_list
 
 class CsvResultsWriter(ResultsWriter):
@@ -101,6 +116,86 @@ class RprojResultsWriter(CsvResultsWriter):
     def write_error(self, exp_dir):
         sys.stderr.write(self.sep.join(map(to_str,[exp_dir,"ERROR"])) + "\n")
         
+
+class SqliteResultsWriter(ResultsWriter):
+    '''Writes the results to a table in a SQLite database, which is updated in place.
+
+    The table has a column for each key, and exp_dir together with exp_row (the 
+    index of the row among those of its experiment directory) is the primary key. 
+    Columns are added as new keys appear, and the nonunique keys are indexed. Only
+    the rows of the scraped directories which changed are written, and rows of 
+    other directories (e.g. from another top_dir) are left as is.
+    '''
+
+    def __init__(self, path, table="results"):
+        self.path = path
+        self.table = table
+        self.index_keys = set()
+
+    def write_nonunique_keys(self, keys):
+        self.index_keys = set(keys)
+
+    def write_results(self, key_order, values_list, get_as_str):
+        keys = [key for key in key_order if not key.startswith("BLANK_COLUMN")]
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                columns = self._add_columns(conn, keys)
+                select = "SELECT %s FROM %s WHERE exp_dir = ? AND exp_row = ?" % \
+                    (", ".join(map(quote_sql, columns)), quote_sql(self.table))
+                insert = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % \
+                    (quote_sql(self.table), ", ".join(map(quote_sql, columns)), ", ".join(["?"] * len(columns)))
+                # Write each row which differs from the old row with the same (exp_dir, exp_row).
+                num_rows = defaultdict(int) # Map from exp_dir to its number of rows.
+                changed, removed = 0, 0
+                for values in values_list:
+                    value_map = dict(zip(key_order, values))
+                    exp_dir = self._to_sql(value_map["exp_dir"], get_as_str)
+                    value_map["exp_row"] = num_rows[exp_dir]
+                    num_rows[exp_dir] += 1
+                    row = tuple([self._to_sql(value_map.get(c), get_as_str) for c in columns])
+                    old_row = conn.execute(select, (exp_dir, value_map["exp_row"])).fetchone()
+                    if old_row is None or tuple(old_row) != row:
+                        conn.execute(insert, row)
+                        changed += 1
+                # Remove the extra old rows of the scraped experiment directories.
+                for exp_dir, n in num_rows.items():
+                    cursor = conn.execute("DELETE FROM %s WHERE exp_dir = ? AND exp_row >= ?" % (quote_sql(self.table)), 
+                                          (exp_dir, n))
+                    removed += cursor.rowcount
+                for key in sorted(self.index_keys.intersection(keys)):
+                    if key == "exp_dir":
+                        continue
+                    conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % 
+                                 (quote_sql(self.table + ":" + key), quote_sql(self.table), quote_sql(key)))
+        finally:
+            conn.close()
+        sys.stderr.write("Wrote %d changed rows and removed %d rows in %s\n" % (changed, removed, self.path))
+
+    def _add_columns(self, conn, keys):
+        '''Creates the table and adds a column for each new key. Returns the list of 
+        all the columns, starting with exp_dir and exp_row.'''
+        conn.execute("CREATE TABLE IF NOT EXISTS %s (exp_dir, exp_row INTEGER, PRIMARY KEY (exp_dir, exp_row))" % 
+                     (quote_sql(self.table)))
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % (quote_sql(self.table)))]
+        existing = set(columns)
+        for key in keys:
+            if key not in existing:
+                # Columns have no type, so that values are stored as given.
+                conn.execute("ALTER TABLE %s ADD COLUMN %s" % (quote_sql(self.table), quote_sql(key)))
+                columns.append(key)
+                existing.add(key)
+        return columns
+
+    def _to_sql(self, value, get_as_str):
+        '''Converts a value to a type stored by SQLite, keeping numbers as numbers.'''
+        if value is None or isinstance(value, (int, long, float)):
+            return value
+        return get_as_str(value).decode("utf-8", "replace")
+
+def quote_sql(name):
+    '''Quotes a table, column or index name for SQLite.'''
+    return '"%s"' % (name.replace('"', '""'))
     
 def add_options(parser):
     '''Takes an OptionParser as input and adds the appropriate options for the Scraper'''
@@ -108,13 +203,133 @@ def add_options(parser):
     parser.add_option('--errors', action="store_true", help="Scrape for errors only")
     parser.add_option('--tsv_file', help="Out file for R-project")
     parser.add_option('--csv_file', help="Out file for CSV")
+    parser.add_option('--sqlite_file', help="SQLite database file to update with the results")
+    parser.add_option('--stream', action="store_true", help="Sort and write the results in bounded memory")
+    parser.add_option('--max_rows_in_memory', type="int", default=100000, help="Max number of rows in memory when streaming")
+    parser.add_option('--jobs', type="int", default=1, help="Number of processes for reading experiment directories")
+    parser.add_option('--cache_file', help="Cache file for the results of unchanged experiment directories")
+    parser.add_option('--cache_size', type="int", default=100000, help="Max number of experiment directories in the cache")
+
+class ScrapeCache:
+    '''A persistent cache of the rows scraped from each experiment directory.
+
+    An entry is reused only if the size and mtime of every file in CACHE_FILES
+    (and the scraper's mode, the path given for the directory, which its rows 
+    record, and the directory's line in the manifest of its exp tree) are unchanged 
+    since the directory was scraped, so only new or changed directories are read 
+    again. Entries are keyed by the absolute path of the directory. When saved, the 
+    entries for deleted directories are dropped, and then the least recently used 
+    entries until at most max_entries remain.
+
+    Note that the cache does not know about changes to the scraper's code: delete 
+    the cache file after changing what a Scraper extracts.
+    '''
+
+    CACHE_FILES = ["stdout", "expparams.txt", "outparams.txt", "DONE"]
+    VERSION = 2
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {} # Map from the absolute path of exp_dir to [signature, result, last used].
+        self.clock = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        if os.path.exists(path):
+            try:
+                f = open(path, 'rb')
+                try:
+                    version, clock, entries = cPickle.load(f)
+                finally:
+                    f.close()
+                if version == ScrapeCache.VERSION:
+                    self.clock, self.entries = clock, entries
+            except Exception, e:
+                sys.stderr.write("WARN: Ignoring unreadable scrape cache %s: %s\n" % (path, e))
+
+    def get_signature(self, exp_dir, mode):
+        '''Gets the mode and exp_dir together with the size and mtime of each of the 
+        cached files (or None if missing).'''
+        signature = [mode, exp_dir]
+        for name in ScrapeCache.CACHE_FILES:
+            try:
+                st = os.stat(os.path.join(exp_dir, name))
+                signature.append((st.st_size, st.st_mtime))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def get(self, exp_dir, signature):
+        '''Returns a pair of whether the exp_dir was found with the given signature,
+        and its cached result.'''
+        self.clock += 1
+        entry = self.entries.get(os.path.abspath(exp_dir))
+        if entry is None or entry[0] != signature:
+            self.num_misses += 1
+            return False, None
+        entry[2] = self.clock
+        self.num_hits += 1
+        return True, entry[1]
+
+    def put(self, exp_dir, signature, result):
+        self.clock += 1
+        self.entries[os.path.abspath(exp_dir)] = [signature, result, self.clock]
+
+    def save(self):
+        '''Evicts old entries and writes the cache to its file.'''
+        for exp_dir in self.entries.keys():
+            if not os.path.isdir(exp_dir):
+                del self.entries[exp_dir]
+        if len(self.entries) > self.max_entries:
+            by_last_used = sorted(self.entries.items(), key=lambda item: item[1][2])
+            for exp_dir, _ in by_last_used[:len(self.entries) - self.max_entries]:
+                del self.entries[exp_dir]
+        # Write to a temporary file first so that an interrupted save cannot corrupt the cache.
+        tmp_path = self.path + ".tmp"
+        f = open(tmp_path, 'wb')
+        try:
+            cPickle.dump((ScrapeCache.VERSION, self.clock, self.entries), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+        sys.stderr.write("Scrape cache: %d hits, %d misses, %d entries\n" % 
+                         (self.num_hits, self.num_misses, len(self.entries)))
+
+# Extracts the candidate error messages for Scraper.scrape_errors, in order of preference.
+_error_extractor = LogExtractor()
+_error_extractor.add_following("java_error", "Exception in thread \"main\" ", LAST)
+_error_extractor.add_group1("exception", "(.*(Error|Exception):.*)", LAST)
+_error_extractor.add_group1("error", "(.*[Ee]rror.*)", LAST)
 
+def _read_run(run):
+    '''Generator over the pickled values of a sorted run (see Scraper._write_sorted_runs).'''
+    run.seek(0)
+    while True:
+        try:
+            yield cPickle.load(run)
+        except EOFError:
+            return
+
+# The Scraper used by the worker processes of Scraper.scrape_exp_dirs. This is set
+# before the worker pool is created so that it is inherited by the forked workers.
+_worker_scraper = None
+
+def _scrape_exp_dir_in_worker(exp_dir):
+    '''Scrapes a single experiment directory in a worker process (see Scraper._scrape_all_exp_dirs).'''
+    return _worker_scraper._try_scrape_exp_dir(exp_dir)
 
 class Scraper:
     
     def __init__(self, options):
         self.remain_only = options.remain
         self.errors_only = options.errors
+        self.jobs = options.jobs
+        self.stream = options.stream
+        self.max_rows_in_memory = options.max_rows_in_memory
+        self.manifests = {} # Map from top_dir to the lines of its manifest, or None.
+        self.cache = None
+        if options.cache_file:
+            self.cache = ScrapeCache(options.cache_file, options.cache_size)
         self.writers = []
         self.closeables = []
         if options.tsv_file:
@@ -125,6 +340,8 @@ class Scraper:
             csv_out = open(options.csv_file, 'w')
             self.writers.append(CsvResultsWriter(csv_out))
             self.closeables.append(csv_out)
+        if options.sqlite_file:
+            self.writers.append(SqliteResultsWriter(options.sqlite_file))
         if len(self.writers) == 0: 
             self.writers.append(RprojResultsWriter(sys.stdout))
 
@@ -155,89 +372,42 @@ class Scraper:
         self.scrape_exp_dirs(exp_dirs)
     
     def scrape_exp_dirs(self, exp_dirs):
+        stream = self.stream
+        if stream and self.process_all.im_func is not Scraper.process_all.im_func:
+            sys.stderr.write("WARN: Not streaming since process_all() is overridden\n")
+            stream = False
+        if stream:
+            self._scrape_exp_dirs_streaming(exp_dirs)
+        else:
+            self._scrape_exp_dirs_in_memory(exp_dirs)
+        # Close any open files.
+        for f in self.closeables:
+            f.close()
+    
+    def _scrape_exp_dirs_in_memory(self, exp_dirs):
         # Read experiment directories
         orig_list = [] # List of original expparams objects (used for column ordering).
         exp_list = []  # List of extracted expparams objects.
-        for i,exp_dir in enumerate(sorted(exp_dirs)):
-            try:
-                # Read name
-                name = os.path.basename(exp_dir)
-                if name.startswith("scrape_") or name.startswith("hyperparam_argmax"):
-                    sys.stderr.write("Skipping %s\n" % (name))
-                    continue
-                sys.stderr.write("Reading %s\n" % (name))
-                sys.stderr.flush()
-
-                exp = self.get_exp_params_instance()
-                
-                stdout_file = os.path.join(exp_dir,"stdout")
-                done_file = os.path.join(exp_dir,"DONE")
-                is_done = os.path.exists(done_file)
-                    
-                if self.remain_only:
-                    # Really we should only print those that are not completed.
-                    # But this is commented out so that we can read off elapsed times as well.
-                    #if is_done:
-                    #    exp_list.pop()
-                    #    continue
-                    stdout_lines = self.read_stdout_lines(stdout_file)
-                    exp.update(exp_dir=exp_dir)
-                    _, _, elapsed = get_time(stdout_lines)
-                    exp.update(elapsed = elapsed)
-                    exp.update(timeRemaining = get_following_literal(stdout_lines, "Time remaining: ", -1))
-                    exp_list.append(exp)
-                elif self.errors_only:
-                    stdout_lines = self.read_stdout_lines(stdout_file)
-                    exp.update(exp_dir=exp_dir)
-                    self.scrape_errors(exp, exp_dir, stdout_file)
-                    if exp.get("error") is None: continue
-                    exp_list.append(exp)
-                else:
-                    # Read experiment parameters
-                    exp.read(os.path.join(exp_dir, "expparams.txt"))                
-                    # Append the original parameters
-                    orig_list.append(exp + self.get_exp_params_instance())                    
-                    # Read the output parameters
-                    if os.path.exists(os.path.join(exp_dir, "outparams.txt")):
-                        outp = self.get_exp_params_instance()
-                        outp.read(os.path.join(exp_dir, "outparams.txt"))
-                        exp += outp
-                    exp.update(exp_dir=exp_dir)
-                    exp.update(is_done=is_done)
-                    # Read stdout
-                    self.scrape_errors(exp, exp_dir, stdout_file)
-                    self.scrape_exp(exp, exp_dir, stdout_file)
-                    
-                    # Optionally add status lines
-                    status_exps = self.scrape_exp_statuses(exp, exp_dir, stdout_file)
-                    if status_exps is not None:
-                        for status_exp in status_exps:
-                            exp_list.append(status_exp)
-                    else:
-                        exp_list.append(exp)
-            except Exception, e:
-                for writer in self.writers:
-                    writer.write_error(exp_dir)
-                import traceback
-                sys.stderr.write(str(e) + '\n')
-                traceback.print_exc()
+        for exp_dir, result, error in self._scrape_all_exp_dirs(sorted(exp_dirs)):
+            if error is not None:
+                self._write_error(exp_dir, error)
+            elif result is not None:
+                orig_exps, exps = result
+                orig_list.extend(orig_exps)
+                exp_list.extend(exps)
+        if self.cache is not None:
+            self.cache.save()
 
         exp_list = self.process_all(orig_list, exp_list)
 
-        # Drop the "old:" prefix for convenience on eval experiments:
         for exp in exp_list:
-            #eval wasn't printing expname: if exp.get("expname") == "eval":
-            for key in exp.keys():
-                if key.startswith("old:"):
-                    value = exp.get(key)
-                    exp.remove(key)
-                    exp.set(key.replace("old:",""), value, False, False)
+            self._drop_old_prefix(exp)
         
         # Choose column header order
         initial_keys = ["exp_dir", "is_done"]
-        exp_orderer = self.get_exp_params_instance()
+        exp_orderer = self._get_exp_orderer(exp_list[-1] if len(exp_list) > 0 else None)
         for exp in exp_list:
-            exp_orderer = exp_orderer.concat(exp)
+            exp_orderer.params.update(exp.params)
         exp_orderer.get_initial_keys = lambda : self._get_column_order(initial_keys, orig_list, exp_list)
         key_order = exp_orderer.get_name_key_order()
     
@@ -250,23 +420,258 @@ class Scraper:
             values_list.append(values)
         values_list = sorted(values_list)
         
+        nonunique_keys = get_nonunique_keys(orig_list)
         for writer in self.writers:
+            writer.write_nonunique_keys(nonunique_keys)
             writer.write_results(key_order, values_list, exp_orderer._get_as_str)
+    
+    def _scrape_exp_dirs_streaming(self, exp_dirs):
+        '''Scrapes like _scrape_exp_dirs_in_memory, but with at most max_rows_in_memory 
+        rows in memory at a time. 
+        
+        The rows are spilled to a temporary file as they are read, while only the
+        statistics needed to order the columns are kept. The rows are then sorted 
+        in runs of max_rows_in_memory, and the sorted runs are merged for each writer.
+        Note that get_column_order() is passed an empty list in this mode.
+        '''
+        spill = tempfile.TemporaryFile()
+        # Only the first value of each original key is kept, so that per-experiment keys
+        # (e.g. seeds or paths) do not take memory per row.
+        orig_first_values = {} # Map from original keys to the first value seen.
+        nonunique_keys = set()
+        orig_exclude_name_keys = set()
+        result_keys = set()
+        num_rows = 0
+        last_exp = None
+        for exp_dir, result, error in self._scrape_all_exp_dirs(sorted(exp_dirs)):
+            if error is not None:
+                self._write_error(exp_dir, error)
+            elif result is not None:
+                orig_exps, exps = result
+                for orig in orig_exps:
+                    _add_nonunique_keys(orig, orig_first_values, nonunique_keys)
+                    orig_exclude_name_keys.update(orig.exclude_name_keys)
+                for exp in exps:
+                    self._drop_old_prefix(exp)
+                    result_keys.update(exp.params)
+                    cPickle.dump(dict(exp.params), spill, cPickle.HIGHEST_PROTOCOL)
+                    num_rows += 1
+                    last_exp = exp
+        if self.cache is not None:
+            self.cache.save()
+        
+        # Choose column header order
+        initial_keys = ["exp_dir", "is_done"]
+        orig_set = set(orig_first_values.keys())
+        exp_orderer = self._get_exp_orderer(last_exp)
+        exp_orderer.params.update(dict.fromkeys(result_keys))
+        exp_orderer.get_initial_keys = lambda : self._order_columns(initial_keys, nonunique_keys, orig_exclude_name_keys, 
+                                                                     orig_set, result_keys, self.get_column_order([]))
+        key_order = exp_orderer.get_name_key_order()
+        
+        # Order rows
+        runs = self._write_sorted_runs(spill, num_rows, key_order)
+        spill.close()
+        try:
+            for writer in self.writers:
+                writer.write_nonunique_keys(nonunique_keys)
+                writer.write_results(key_order, heapq.merge(*map(_read_run, runs)), exp_orderer._get_as_str)
+        finally:
+            for run in runs:
+                run.close()
+    
+    def _write_sorted_runs(self, spill, num_rows, key_order):
+        '''Reads the spilled params of each row, and writes their values (ordered by key_order)
+        to temporary files in sorted runs of max_rows_in_memory rows.'''
+        spill.seek(0)
+        runs = []
+        while num_rows > 0:
+            values_list = []
+            for _ in xrange(min(num_rows, self.max_rows_in_memory)):
+                params = cPickle.load(spill)
+                values_list.append([params.get(key) for key in key_order])
+            num_rows -= len(values_list)
+            values_list.sort()
+            run = tempfile.TemporaryFile()
+            for values in values_list:
+                cPickle.dump(values, run, cPickle.HIGHEST_PROTOCOL)
+            runs.append(run)
+        return runs
+    
+    def _write_error(self, exp_dir, error):
+        for writer in self.writers:
+            writer.write_error(exp_dir)
+        sys.stderr.write(error)
+    
+    def _drop_old_prefix(self, exp):
+        '''Drops the "old:" prefix for convenience on eval experiments.'''
+        #eval wasn't printing expname: if exp.get("expname") == "eval":
+        for key in exp.keys():
+            if key.startswith("old:"):
+                value = exp.get(key)
+                exp.remove(key)
+                exp.set(key.replace("old:",""), value, False, False)
+    
+    def _get_exp_orderer(self, last_exp):
+        '''Gets an empty ExpParams for ordering the columns, whose class is that of the
+        last row (as if all the rows were concatenated).'''
+        if last_exp is None:
+            return self.get_exp_params_instance()
+        return last_exp.get_instance()
+        
+    def _scrape_all_exp_dirs(self, exp_dirs):
+        '''Generates a tuple (exp_dir, result, error) for each of the experiment directories, in 
+        order (see _try_scrape_exp_dir). If there is a cache, only the directories which 
+        changed are read.
+        '''
+        # Load the manifests before any worker processes are forked.
+        for exp_dir in exp_dirs:
+            self._get_manifest_line(exp_dir)
+        if self.cache is None:
+            for exp_result_error in self._read_all_exp_dirs(exp_dirs):
+                yield exp_result_error
+            return
+        mode = (self.__class__.__module__, self.__class__.__name__, self.remain_only, self.errors_only)
+        signatures = {}
+        cached = {}
+        for exp_dir in exp_dirs:
+            signatures[exp_dir] = self.cache.get_signature(exp_dir, mode) + (self._get_manifest_line(exp_dir),)
+            hit, result = self.cache.get(exp_dir, signatures[exp_dir])
+            if hit:
+                cached[exp_dir] = result
+        changed = self._read_all_exp_dirs([d for d in exp_dirs if d not in cached])
+        for exp_dir in exp_dirs:
+            if exp_dir in cached:
+                yield exp_dir, cached[exp_dir], None
+                continue
+            exp_dir, result, error = changed.next()
+            if error is None:
+                self.cache.put(exp_dir, signatures[exp_dir], result)
+            yield exp_dir, result, error
+    
+    def _read_all_exp_dirs(self, exp_dirs):
+        '''Generates a tuple (exp_dir, result, error) for each of the experiment directories, in 
+        order (see _try_scrape_exp_dir). If self.jobs > 1, the directories are read in parallel
+        by a pool of worker processes.
+        '''
+        if self.jobs <= 1:
+            for exp_dir in exp_dirs:
+                yield self._try_scrape_exp_dir(exp_dir)
+            return
+        global _worker_scraper
+        _worker_scraper = self
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for exp_result_error in pool.imap(_scrape_exp_dir_in_worker, exp_dirs, chunksize=8):
+                yield exp_result_error
+        finally:
+            pool.close()
+            pool.join()
+            _worker_scraper = None
+    
+    def _try_scrape_exp_dir(self, exp_dir):
+        '''Returns a tuple of the experiment directory, the result of _scrape_exp_dir 
+        (or None on error), and the error message with its traceback (or None).
+        '''
+        try:
+            return exp_dir, self._scrape_exp_dir(exp_dir), None
+        except Exception, e:
+            return exp_dir, None, str(e) + '\n' + traceback.format_exc()
+    
+    def _scrape_exp_dir(self, exp_dir):
+        '''Reads a single experiment directory. 
+        
+        Returns a pair of lists of the original expparams and the extracted expparams,
+        or None if the directory is skipped.
+        '''
+        orig_list = []
+        exp_list = []
+        # Read name
+        name = os.path.basename(exp_dir)
+        if name.startswith("scrape_") or name.startswith("hyperparam_argmax"):
+            sys.stderr.write("Skipping %s\n" % (name))
+            return None
+        sys.stderr.write("Reading %s\n" % (name))
+        sys.stderr.flush()
+
+        exp = self.get_exp_params_instance()
+        
+        stdout_file = os.path.join(exp_dir,"stdout")
+        done_file = os.path.join(exp_dir,"DONE")
+        is_done = os.path.exists(done_file)
             
-        # Close any open files.
-        for f in self.closeables:
-            f.close()
+        if self.remain_only:
+            # Really we should only print those that are not completed.
+            # But this is commented out so that we can read off elapsed times as well.
+            #if is_done:
+            #    return None
+            stdout_lines = self.read_stdout_lines(stdout_file)
+            exp.update(exp_dir=exp_dir)
+            _, _, elapsed = get_time(stdout_lines)
+            exp.update(elapsed = elapsed)
+            exp.update(timeRemaining = get_following_literal(stdout_lines, "Time remaining: ", -1))
+            exp_list.append(exp)
+        elif self.errors_only:
+            stdout_lines = self.read_stdout_lines(stdout_file)
+            exp.update(exp_dir=exp_dir)
+            self.scrape_errors(exp, exp_dir, stdout_file)
+            if exp.get("error") is None: return None
+            exp_list.append(exp)
+        else:
+            # Read experiment parameters, from the manifest if the directory is in it.
+            manifest_line = self._get_manifest_line(exp_dir)
+            if manifest_line is not None:
+                exp.read_typed_params(parse_manifest_line(manifest_line))
+            else:
+                exp.read(os.path.join(exp_dir, "expparams.txt"))
+            # Append the original parameters
+            orig_list.append(exp + self.get_exp_params_instance())                    
+            # Read the output parameters
+            if os.path.exists(os.path.join(exp_dir, "outparams.txt")):
+                outp = self.get_exp_params_instance()
+                outp.read(os.path.join(exp_dir, "outparams.txt"))
+                exp += outp
+            exp.update(exp_dir=exp_dir)
+            exp.update(is_done=is_done)
+            # Read stdout
+            self.scrape_errors(exp, exp_dir, stdout_file)
+            self.scrape_exp(exp, exp_dir, stdout_file)
+            
+            # Optionally add status lines
+            status_exps = self.scrape_exp_statuses(exp, exp_dir, stdout_file)
+            if status_exps is not None:
+                for status_exp in status_exps:
+                    exp_list.append(status_exp)
+            else:
+                exp_list.append(exp)
+        return orig_list, exp_list
+        
+    def _get_manifest_line(self, exp_dir):
+        '''Gets the line for exp_dir in the manifest of its exp tree (see manifest.py), or None
+        if there is no manifest or the directory is not in it. Each manifest is read once.'''
+        top_dir, name = os.path.split(os.path.normpath(exp_dir))
+        if top_dir not in self.manifests:
+            lines = None
+            path = get_manifest_path(top_dir)
+            if os.path.exists(path):
+                lines = read_manifest_lines(path)
+            self.manifests[top_dir] = lines
+        lines = self.manifests[top_dir]
+        if lines is None:
+            return None
+        return lines.get(name)
         
     def _get_column_order(self, initial_keys, orig_list, exp_list):
+        return self._order_columns(initial_keys, get_nonunique_keys(orig_list), get_exclude_name_keys(orig_list),
+                                   get_all_keys(orig_list), get_all_keys(exp_list), self.get_column_order(exp_list))
+    
+    def _order_columns(self, initial_keys, nonunique_keys, exclude_name_keys, orig_set, all_result_keys, column_order):
         order = []
         added = set()
-        nonunique_keys = get_nonunique_keys(orig_list)
-        exclude_name_keys = get_exclude_name_keys(orig_list)
         initial_set = nonunique_keys - exclude_name_keys
-        orig_set = get_all_keys(orig_list)
-        result_set = get_all_keys(exp_list) - orig_set
+        result_set = all_result_keys - orig_set
         
-        unfiltered = initial_keys + list(initial_set) + ["BLANK_COLUMN1"] + self.get_column_order(exp_list) + \
+        unfiltered = initial_keys + list(initial_set) + ["BLANK_COLUMN1"] + column_order + \
                        ["BLANK_COLUMN2"] + sorted(list(result_set)) + sorted(list(orig_set))
         
         for key in unfiltered:
@@ -283,9 +688,10 @@ class Scraper:
         stdout_lines = [x for x in stdout_lines if x.find("module: line 1: syntax error: unexpected end of file") == -1]
         stdout_lines = [x for x in stdout_lines if x.find("error importing function definition for `BASH_FUNC_module'") == -1]
         # Check for errors:
-        error = get_following(stdout_lines, "Exception in thread \"main\" ", -1, False)
-        if error == None: error = get_group1(stdout_lines, "(.*(Error|Exception):.*)", -1)
-        if error == None: error = get_group1(stdout_lines, "(.*[Ee]rror.*)", -1)
+        errors = _error_extractor.extract(stdout_lines)
+        error = errors["java_error"]
+        if error == None: error = errors["exception"]
+        if error == None: error = errors["error"]
         exp.update(error = error)
         
     def get_exp_params_instance(self):
@@ -0,0 +1,240 @@
+'''
+A content-addressed cache of the outputs of completed stages, shared by runs of pipelines.
+
+Each stage is identified by a hash (see get_stage_hash) of its script (from
+create_stage_script), its arguments (for an ExpParams) and the hashes of its prereqs,
+so a stage hashes the same in a later run of the pipeline (in a new exp tree) exactly
+when it would do the same work on the same inputs. When a stage completes, its script
+copies its directory into the cache, and makes the copied files read-only. When a later
+run creates a stage with the same hash, the cached files are linked into its new
+directory (by hard links if possible) instead of running it again. Since the files of an
+entry are never linked to the files of a running stage, and the links are read-only, an
+entry cannot be changed by a stage which writes to its files in place.
+
+Note that the hash does not cover the files which a script reads other than the outputs
+of its prereqs (e.g. code, data or setupenv.sh): clear the cache after changing them.
+
+Layout of the cache directory:
+    entries/<hash>/  The files of each completed stage.
+    tmp/             Partial entries, being copied by the stage scripts.
+    sizes.pickle     The size of each entry, so that eviction only measures new entries.
+
+@author: mgormley
+'''
+
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import cPickle
+
+# The file in a stage's directory which lists the paths (relative to the directory) that
+# StageCache.link linked or created there.
+LINKS_FILE = "stage-cache-links.txt"
+
+class StageCache:
+    '''A cache directory of the outputs of completed stages (see the module docstring).
+
+    Entries are evicted, least recently used first, when the cache is larger than
+    max_megs (or never if max_megs is None). An entry is used when it is created or
+    linked into a stage's directory, which updates its mtime.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, cache_dir, max_megs=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_megs = max_megs
+        self.entries_dir = os.path.join(self.cache_dir, "entries")
+        self.tmp_dir = os.path.join(self.cache_dir, "tmp")
+        self.num_hits = 0
+        self.num_misses = 0
+        for d in [self.entries_dir, self.tmp_dir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def get_entry_dir(self, stage_hash):
+        return os.path.join(self.entries_dir, stage_hash)
+
+    def link(self, stage_hash, cwd, completion_indicator):
+        '''Links the files of the cached entry (if any) into the stage directory cwd, with hard
+        links if possible and otherwise symbolic links. The links are read-only, like the
+        files of the entry. Files which already exist in cwd are kept. The completion
+        indicator is linked last. The paths are listed in LINKS_FILE (see unlink_entry).
+        Returns True iff the entry was linked.'''
+        entry_dir = self.get_entry_dir(stage_hash)
+        if not os.path.exists(os.path.join(entry_dir, completion_indicator)):
+            self.num_misses += 1
+            return False
+        linked = []
+        try:
+            last = None
+            for dirpath, dirnames, filenames in os.walk(entry_dir):
+                rel_dir = os.path.relpath(dirpath, entry_dir)
+                for dirname in dirnames:
+                    path = os.path.normpath(os.path.join(cwd, rel_dir, dirname))
+                    if not os.path.isdir(path):
+                        os.mkdir(path)
+                        linked.append(path)
+                for filename in filenames:
+                    src = os.path.join(dirpath, filename)
+                    dest = os.path.normpath(os.path.join(cwd, rel_dir, filename))
+                    if rel_dir == "." and filename == completion_indicator:
+                        last = (src, dest)
+                    elif not os.path.lexists(dest):
+                        _link_file(src, dest)
+                        linked.append(dest)
+            links_path = os.path.join(cwd, LINKS_FILE)
+            out = open(links_path, 'w')
+            linked.append(links_path)
+            for path in linked[:-1] + [last[1]]:
+                out.write(os.path.relpath(path, cwd) + "\n")
+            out.close()
+            _link_file(*last)
+        except OSError, e:
+            # E.g. the entry was evicted while being linked. Remove the links, so that
+            # running the stage cannot write through them into the cache.
+            sys.stderr.write("WARN: Failed to link cached stage %s: %s\n" % (entry_dir, e))
+            for path in reversed(linked):
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.lexists(path):
+                    os.remove(path)
+            self.num_misses += 1
+            return False
+        try:
+            os.utime(entry_dir, None)
+        except OSError:
+            pass
+        self.num_hits += 1
+        return True
+
+    def get_store_script(self, stage_hash):
+        '''Gets the bash script which stores the stage's directory (the current directory) in
+        the cache, to be run after the stage completes. It never fails, since the stage has
+        completed either way.
+
+        The files are copied rather than hard linked, since the stage's directory stays
+        writable (e.g. a rolling run reruns a changed stage in place).'''
+        entry_dir = self.get_entry_dir(stage_hash)
+        return '''
+# Store a read-only copy of the outputs of this stage in the stage cache.
+CACHE_ENTRY='%(entry_dir)s'
+if [[ ! -e $CACHE_ENTRY ]] && CACHE_TMP=`mktemp -d '%(tmp_dir)s/%(hash)s.XXXXXX'` ; then
+    if cp -a . $CACHE_TMP/files && find $CACHE_TMP/files -type f -exec chmod a-w {} + ; then
+        mv -T $CACHE_TMP/files $CACHE_ENTRY 2>/dev/null
+    fi
+    rm -rf $CACHE_TMP
+fi
+true
+''' % {"entry_dir" : entry_dir, "tmp_dir" : self.tmp_dir, "hash" : stage_hash}
+
+    def evict(self):
+        '''Removes the least recently used entries until the cache is at most max_megs.'''
+        if self.max_megs is None:
+            return
+        sizes_file = os.path.join(self.cache_dir, "sizes.pickle")
+        sizes = {}
+        if os.path.exists(sizes_file):
+            try:
+                f = open(sizes_file, 'rb')
+                try:
+                    version, sizes = cPickle.load(f)
+                finally:
+                    f.close()
+                if version != StageCache.VERSION:
+                    sizes = {}
+            except Exception, e:
+                sys.stderr.write("WARN: Ignoring unreadable stage cache sizes %s: %s\n" % (sizes_file, e))
+                sizes = {}
+        entries = []
+        for stage_hash in os.listdir(self.entries_dir):
+            entry_dir = self.get_entry_dir(stage_hash)
+            try:
+                mtime = os.stat(entry_dir).st_mtime
+            except OSError:
+                continue
+            if stage_hash not in sizes:
+                sizes[stage_hash] = _get_size(entry_dir)
+            entries.append((mtime, stage_hash))
+        sizes = dict((stage_hash, sizes[stage_hash]) for _, stage_hash in entries)
+        total = sum(sizes.values())
+        max_bytes = self.max_megs * 1024 * 1024
+        for _, stage_hash in sorted(entries):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(self.get_entry_dir(stage_hash), ignore_errors=True)
+            total -= sizes.pop(stage_hash)
+        # Write to a temporary file first so that an interrupted write cannot corrupt the sizes.
+        tmp_file = sizes_file + ".%d.tmp" % (os.getpid())
+        f = open(tmp_file, 'wb')
+        try:
+            cPickle.dump((StageCache.VERSION, sizes), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp_file, sizes_file)
+        print "Stage cache: %d entries, %.1f MB" % (len(sizes), total / 1024.0 / 1024.0)
+
+def get_stage_hash(stage, script, exp_dir):
+    '''Gets the hash of a stage whose script (from create_stage_script) is given, or None if 
+    the stage is not cacheable or the hash of one of its prereqs is unknown.'''
+    if not stage.cacheable:
+        return None
+    prereq_hashes = []
+    for prereq in stage.prereqs:
+        if prereq.stage_hash is None:
+            return None
+        prereq_hashes.append(prereq.stage_hash)
+    # Paths into the exp tree (e.g. to the directories of prereqs) differ between runs.
+    tree_dir = os.path.dirname(os.path.abspath(exp_dir))
+    script = script.replace(tree_dir, "${EXP_TREE}")
+    args = stage.get_args().replace(tree_dir, "${EXP_TREE}") if hasattr(stage, "get_args") else ""
+    h = hashlib.sha1()
+    for part in [str(StageCache.VERSION), stage.completion_indicator, script, args] + prereq_hashes:
+        h.update(part)
+        h.update("\0")
+    return h.hexdigest()
+
+def unlink_entry(cwd):
+    '''Removes the files which StageCache.link linked into the stage directory cwd, and the
+    directories it created there if they are empty, so that rerunning the stage cannot write
+    through them into the cache. Other files are kept. Returns whether cwd had linked files.'''
+    links_path = os.path.join(cwd, LINKS_FILE)
+    if not os.path.exists(links_path):
+        return False
+    f = open(links_path, 'r')
+    try:
+        paths = [os.path.join(cwd, line.rstrip("\n")) for line in f]
+    finally:
+        f.close()
+    # The directories are listed before their files.
+    for path in reversed(paths):
+        if os.path.isdir(path) and not os.path.islink(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass # Not empty.
+        elif os.path.lexists(path):
+            os.remove(path)
+    os.remove(links_path)
+    return True
+
+def _link_file(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        os.symlink(src, dest)
+
+def _get_size(path):
+    '''Gets the total size in bytes of the files under path.'''
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
@@ -49,6 +49,9 @@ class ScrapeExps(experiment_runner.PythonExpParams):
     
     def create_experiment_script(self, exp_dir):
         self.add_arg(os.path.dirname(exp_dir))
+        if self.get("cache_file") is None:
+            # Reuse the results of unchanged experiments when this stage is relaunched.
+            self.set("cache_file", os.path.join(exp_dir, "scrape-cache.pickle"), False, True)
         script = ""
         cmd = "scrape_exps.py %s\n" % (self.get_args())
         script += fancify_cmd(cmd)
@@ -68,7 +71,7 @@ def get_oome_stages(stage, max_mem=100*1000, max_doubles=4):
             break
         doubled = stage.copy_with(work_mem_megs=mem)
         doubled.set("memory", str(mem)+"M", incl_arg=False)
-        doubled.script_fns.append(prereqs_create_experiment_script)        
+        doubled.add_script_fn(prereqs_create_experiment_script)        
         doubled.add_prereq(stages[len(stages)-1])
         stages += [doubled]
     return stages
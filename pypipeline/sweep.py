@@ -0,0 +1,225 @@
+'''
+Lazy sweeps over grids of experiment parameters.
+
+A sweep is built from axes, each of which gives the values of one key, e.g.
+
+    sweep = Axis("lr", frange(0.1, 1.0, 0.1)) * Axis("reg", logspace(-4, 0, 5))
+    sweep = sweep * Axis("seed", range(3)).zip(Axis("data", ["a", "b", "c"]))
+    sweep = sweep.filter(lambda params: params["lr"] * params["reg"] < 0.1)
+
+and generates its points lazily, so that a huge grid can be streamed to
+ExpParamsRunner.run_sweep() without building a list of all its ExpParams.
+
+@author: mgormley
+'''
+
+import math
+import itertools
+from pypipeline import util
+from pypipeline.experiment_runner import ExpParams
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Sweep:
+    '''A lazy sequence of points, where each point is a tuple of values for the keys.
+
+    Attributes:
+        keys: List of the keys, in the order of the values of each point.
+        exclude_name_keys: Set of the keys excluded from the names of the experiments.
+        exclude_arg_keys: Set of the keys excluded from the arguments of the experiments.
+    '''
+
+    def __init__(self, keys, exclude_name_keys=(), exclude_arg_keys=()):
+        self.keys = list(keys)
+        self.exclude_name_keys = set(exclude_name_keys)
+        self.exclude_arg_keys = set(exclude_arg_keys)
+
+    def points(self):
+        '''OVERRIDE THIS METHOD: generates the points of this sweep.'''
+        raise NotImplementedError()
+
+    def get_varied_keys(self):
+        '''OVERRIDE THIS METHOD: gets the set of keys which may take more than one value.'''
+        raise NotImplementedError()
+
+    def cross(self, other):
+        '''Gets the sweep over all combinations of the points of self and other.'''
+        return Cross(self, other)
+
+    def zip(self, other):
+        '''Gets the sweep which pairs up the points of self and other in order.'''
+        return Zip(self, other)
+
+    def filter(self, predicate):
+        '''Gets the sweep over the points for which predicate(params) is true, where
+        params is a dict mapping the keys to the values of a point.'''
+        return Filter(self, predicate)
+
+    def __mul__(self, other):
+        return self.cross(other)
+
+    def __iter__(self):
+        return self.get_exps()
+
+    def get_exps(self, base=None):
+        '''Generates an ExpParams for each point, by adding its values to a copy of base
+        (by default, an empty ExpParams).'''
+        if base is None:
+            base = ExpParams()
+        for point in self.points():
+            exp = base.concat(dict(itertools.izip(self.keys, point)))
+            for key in self.exclude_name_keys:
+                exp.set_incl_name(key, False)
+            for key in self.exclude_arg_keys:
+                exp.set_incl_arg(key, False)
+            yield exp
+
+class Axis(Sweep):
+    '''A sweep over the values of a single key.'''
+
+    def __init__(self, key, values, incl_name=True, incl_arg=True):
+        Sweep.__init__(self, [key], [] if incl_name else [key], [] if incl_arg else [key])
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            # Convert to python types, e.g. so that values are printed as usual.
+            values = values.tolist()
+        self.values = list(values)
+
+    def points(self):
+        for value in self.values:
+            yield (value,)
+
+    def get_varied_keys(self):
+        if len(set(self.values)) > 1:
+            return set(self.keys)
+        return set()
+
+    def __len__(self):
+        return len(self.values)
+
+class Cross(Sweep):
+    '''A sweep over all combinations of the points of other sweeps, varying the last fastest.'''
+
+    def __init__(self, *sweeps):
+        Sweep.__init__(self, _get_all_keys(sweeps), _union(s.exclude_name_keys for s in sweeps),
+                       _union(s.exclude_arg_keys for s in sweeps))
+        self.sweeps = sweeps
+
+    def points(self):
+        # Only the points of the first sweep are not materialized.
+        rest = [list(s.points()) for s in self.sweeps[1:]]
+        for first in self.sweeps[0].points():
+            for others in itertools.product(*rest):
+                yield first + sum(others, ())
+
+    def get_varied_keys(self):
+        return _union(s.get_varied_keys() for s in self.sweeps)
+
+    def __len__(self):
+        return reduce(lambda x, y: x * y, [len(s) for s in self.sweeps], 1)
+
+class Zip(Sweep):
+    '''A sweep which pairs up the points of other sweeps in order. The sweeps must have
+    the same number of points.'''
+
+    def __init__(self, *sweeps):
+        Sweep.__init__(self, _get_all_keys(sweeps), _union(s.exclude_name_keys for s in sweeps),
+                       _union(s.exclude_arg_keys for s in sweeps))
+        self.sweeps = sweeps
+
+    def points(self):
+        iters = [s.points() for s in self.sweeps]
+        while True:
+            point = ()
+            num_done = 0
+            for it in iters:
+                try:
+                    point += it.next()
+                except StopIteration:
+                    num_done += 1
+            if num_done == len(iters):
+                return
+            if num_done > 0:
+                raise ValueError("Zipped sweeps have different numbers of points: " + str(self.keys))
+            yield point
+
+    def get_varied_keys(self):
+        return _union(s.get_varied_keys() for s in self.sweeps)
+
+    def __len__(self):
+        return len(self.sweeps[0])
+
+class Filter(Sweep):
+    '''A sweep over the points of another sweep which satisfy a predicate.'''
+
+    def __init__(self, sweep, predicate):
+        Sweep.__init__(self, sweep.keys, sweep.exclude_name_keys, sweep.exclude_arg_keys)
+        self.sweep = sweep
+        self.predicate = predicate
+
+    def points(self):
+        for point in self.sweep.points():
+            if self.predicate(dict(itertools.izip(self.keys, point))):
+                yield point
+
+    def get_varied_keys(self):
+        # The filter could leave a single value for a key, but this is not known without
+        # generating all the points.
+        return self.sweep.get_varied_keys()
+
+def _get_all_keys(sweeps):
+    keys = []
+    for s in sweeps:
+        for key in s.keys:
+            if key in keys:
+                raise ValueError("Key appears in more than one sweep: " + key)
+            keys.append(key)
+    return keys
+
+def _union(sets):
+    union = set()
+    for s in sets:
+        union.update(s)
+    return union
+
+# ------------------- Numeric axis values ------------------------
+#
+# Each value is computed directly from its index, without accumulating rounding 
+# errors, by the same formula with or without NumPy (so that the names of the 
+# experiments do not depend on whether it is installed).
+
+def frange(bottom, top, delta):
+    '''Gets the values from bottom to top (inclusive) in steps of delta (as util.frange).'''
+    num = int(math.floor((top - bottom) / float(delta) + 1e-9)) + 1
+    if numpy is not None:
+        return (bottom + delta * numpy.arange(num)).tolist()
+    return [bottom + delta * i for i in range(num)]
+
+def linspace(start, stop, num):
+    '''Gets num evenly spaced values from start to stop (inclusive).'''
+    if num == 1:
+        return [float(start)]
+    step = (stop - start) / float(num - 1)
+    if numpy is not None:
+        values = (start + step * numpy.arange(num)).tolist()
+    else:
+        values = [start + step * i for i in range(num)]
+    values[-1] = float(stop)
+    return values
+
+def logspace(start, stop, num, base=10.0):
+    '''Gets num values evenly spaced on a log scale from base**start to base**stop (inclusive).'''
+    exponents = linspace(start, stop, num)
+    if numpy is not None:
+        return numpy.power(float(base), exponents).tolist()
+    return [float(base) ** x for x in exponents]
+
+def sweep_mult(middle_val, factor, num_vals):
+    '''Gets num_vals values, each factor times the previous, around middle_val (as util.sweep_mult).'''
+    middle_val, factor = float(middle_val), float(factor)
+    first = int(math.floor(num_vals * 0.5))
+    if numpy is not None:
+        return (middle_val * numpy.power(factor, numpy.arange(num_vals) - first)).tolist()
+    return [middle_val * factor ** (i - first) for i in range(num_vals)]
@@ -1,27 +1,166 @@
 from collections import deque
-from pipeline import dfs_stages
 
-def bfs_topo_sort(root_stage):
-    '''A breadth first search for topological sorting, first described by Kahn (1962).'''
+def bfs_order(root_stage):
+    '''Gets the stages reachable from root_stage (via dependents) in breadth first order.
+
+    Each stage is visited exactly once, so this runs in O(V+E) time even on graphs
+    with many paths to the same stage (e.g. diamonds).
+    '''
+    order = [root_stage]
+    visited = set(order)
+    i = 0
+    while i < len(order):
+        for dependent in order[i].dependents:
+            if dependent not in visited:
+                visited.add(dependent)
+                order.append(dependent)
+        i += 1
+    return order
+
+def dfs_order(root_stage):
+    '''Gets the stages reachable from root_stage (via dependents) in depth first preorder.
+
+    Each stage is visited exactly once, so this runs in O(V+E) time. The search is
+    iterative so that very deep pipelines do not exceed the recursion limit.
+    '''
+    order = []
+    visited = set()
+    stack = [root_stage]
+    while len(stack) > 0:
+        stage = stack.pop()
+        if stage in visited:
+            continue
+        visited.add(stage)
+        order.append(stage)
+        # Push in reverse so that the first dependent is visited first.
+        for dependent in reversed(stage.dependents):
+            if dependent not in visited:
+                stack.append(dependent)
+    return order
+
+def dfs_stages(root_stage):
+    '''Gets the set of stages reachable from root_stage.'''
+    return set(dfs_order(root_stage))
+
+def bfs_stages(root_stage):
+    '''Gets the set of stages reachable from root_stage.'''
+    return set(bfs_order(root_stage))
+
+class CycleError(Exception):
+    '''Raised when the dependency graph has a cycle.
+
+    Attributes:
+        cycle: List of the stages on the cycle, where each stage is a prereq of the next
+            and the last stage is a prereq of the first.
+    '''
+
+    def __init__(self, cycle):
+        Exception.__init__(self, "Dependency graph has a cycle: " + " -> ".join(map(str, cycle + cycle[:1])))
+        self.cycle = cycle
+
+def topo_sort_with_levels(root_stage):
+    '''A breadth first search for topological sorting, first described by Kahn (1962).
+
+    Returns a pair (order, levels) where order is the list of stages reachable from
+    root_stage such that each stage comes after all of its prereqs, and levels maps
+    each stage to its depth: the length of the longest path to it from root_stage.
+    Runs in O(V+E) time by counting the unsorted prereqs of each stage.
+    '''
     # Algorithm follows Wikipedia: http://en.wikipedia.org/wiki/Topological_sorting
-    edges = set()
-    for n in dfs_stages(root_stage):
+    stages = bfs_order(root_stage)
+    in_degree = dict((n, 0) for n in stages)
+    for n in stages:
         for m in n.dependents:
-            edges.add((n,m))
-    
-    done = []
+            in_degree[m] += 1
+
+    order = []
+    levels = {root_stage: 0}
     todo = deque([root_stage])
     while len(todo) > 0:
         n = todo.popleft()
-        done.append(n)
+        order.append(n)
+        level = levels[n] + 1
         for m in n.dependents:
-            edges.remove((n, m))
-            m_ready = True
-            for p in m.prereqs:
-                if (p, m) in edges:
-                    m_ready = False
-                    break
-            if m_ready:
+            if levels.get(m, -1) < level:
+                levels[m] = level
+            in_degree[m] -= 1
+            if in_degree[m] == 0:
                 todo.append(m)
-    assert len(edges) == 0, "Dependency graph has a cycle"
-    return done
+    if len(order) != len(stages):
+        raise CycleError(_find_cycle([n for n in stages if in_degree[n] > 0]))
+    return order, levels
+
+def _find_cycle(unsorted):
+    '''Finds a cycle among the stages left unsorted by Kahn's algorithm.
+
+    Every unsorted stage has an unsorted prereq, so walking backwards along
+    unsorted prereqs must eventually revisit a stage.
+    '''
+    unsorted_set = set(unsorted)
+    path = []
+    position = {}
+    stage = unsorted[0]
+    while stage not in position:
+        position[stage] = len(path)
+        path.append(stage)
+        stage = [p for p in stage.prereqs if p in unsorted_set][0]
+    cycle = path[position[stage]:]
+    cycle.reverse()
+    return cycle
+
+def _get_cached_topo_sort(root_stage):
+    '''Gets the (order, levels) for root_stage, caching them on the root stage.
+
+    The cache is invalidated whenever any stage's prereqs or dependents are changed 
+    through Stage.add_prereq() or Stage.add_dependent(), which increment the 
+    graph_version shared by all stages.
+    '''
+    version = getattr(root_stage, "graph_version", None)
+    cache = getattr(root_stage, "_topo_cache", None)
+    if cache is None or version is None or cache[0] != version:
+        order, levels = topo_sort_with_levels(root_stage)
+        cache = (version, order, levels)
+        root_stage._topo_cache = cache
+    return cache[1], cache[2]
+
+def bfs_topo_sort(root_stage):
+    '''Gets the stages reachable from root_stage in topological order (see topo_sort_with_levels).'''
+    order, _ = _get_cached_topo_sort(root_stage)
+    return list(order)
+
+def get_stage_levels(root_stage):
+    '''Gets a dict mapping each stage reachable from root_stage to its depth (see topo_sort_with_levels).'''
+    _, levels = _get_cached_topo_sort(root_stage)
+    return dict(levels)
+
+def get_bottom_levels(order, get_minutes):
+    '''Gets a dict mapping each stage in order to its bottom level: the minutes of the
+    longest path from the start of the stage to the end of the pipeline, where each
+    stage takes get_minutes(stage) minutes. Only the stages in order are on the paths.
+
+    The stages with the largest bottom levels are on the critical path, and starting
+    them first keeps the makespan short. Since order must be topological, this runs
+    in O(V+E) time.
+    '''
+    levels = {}
+    for stage in reversed(order):
+        level = 0
+        for dependent in stage.dependents:
+            if levels.get(dependent, 0) > level:
+                level = levels[dependent]
+        levels[stage] = get_minutes(stage) + level
+    return levels
+
+def get_critical_path(order, levels):
+    '''Gets the longest path through the stages in order, given their bottom levels
+    from get_bottom_levels.'''
+    if len(order) == 0:
+        return []
+    stage = max(order, key=lambda s: levels[s])
+    path = [stage]
+    while True:
+        dependents = [d for d in stage.dependents if d in levels]
+        if len(dependents) == 0:
+            return path
+        stage = max(dependents, key=lambda s: levels[s])
+        path.append(stage)
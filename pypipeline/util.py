@@ -1,21 +1,48 @@
 import os
 import math
 import re
+import mmap
+import time
+import errno
+import itertools
 
 # ------------------- File reading ------------------------
 
 def tail(filename, window=20):
     '''Returns the last window lines of a file.'''
-    num_lines = 0
-    all_chunks = ''
-    for chunk in reverse_byte_generator(filename):
-        num_lines = chunk.count('\n')
-        all_chunks = chunk + all_chunks
-        if num_lines >= window:
+    if window <= 0:
+        return []
+    lines = []
+    for line in reverse_line_generator(filename):
+        lines.append(line)
+        if len(lines) >= window:
             break
-    lines = all_chunks.splitlines(True)
+    lines.reverse()
+    # Split on the other line endings (e.g. carriage returns) as well.
+    lines = "".join(lines).splitlines(True)
     return lines[-window:]
 
+def reverse_line_generator(filename):
+    '''Generator for iterating over the lines of a file in reverse order.
+
+    Each line keeps its trailing newline. The file is memory mapped, so only the
+    pages holding the lines which are read are loaded, regardless of the file size.
+    '''
+    with open(filename, 'rb') as f:
+        num_bytes = os.fstat(f.fileno()).st_size
+        if num_bytes == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            end = num_bytes
+            while end > 0:
+                # Skip the newline which ends this line.
+                start = m.rfind('\n', 0, end - 1) + 1
+                yield m[start:end]
+                end = start
+        finally:
+            m.close()
+
 def reverse_byte_generator(filename):  
     '''Generator for iterating over chunks of a file in reverse order.'''  
     with open(filename, 'r') as f:
@@ -54,6 +81,31 @@ def _head_sentences(in_file, out, num_sentences):
 
 # ------------------- Scraping utilities ------------------------
 
+# Compiled regexes, keyed by their pattern strings (see get_compiled).
+_compiled_regexes = {}
+# The max number of compiled regexes to keep. As in re's own cache, the cache is
+# cleared when it is full, so that dynamic patterns cannot grow it without bound.
+_MAX_COMPILED_REGEXES = 500
+
+def get_compiled(regex_str):
+    '''Gets the compiled regex for a pattern string, compiling each pattern only once
+    (unless more than _MAX_COMPILED_REGEXES patterns are used).'''
+    regex = _compiled_regexes.get(regex_str)
+    if regex is None:
+        regex = re.compile(regex_str)
+        if len(_compiled_regexes) >= _MAX_COMPILED_REGEXES:
+            _compiled_regexes.clear()
+        _compiled_regexes[regex_str] = regex
+    return regex
+
+time_regex = re.compile("(.*)user (.*)system (.*)elapsed")
+
+# Matches numbered or named backreferences in a regex.
+backreference_regex = re.compile(r"\\[1-9]|\(\?P=")
+
+# Matches inline flags in a regex (e.g. "(?x)"), which apply to the whole regex.
+inline_flags_regex = re.compile(r"\(\?[iLmsux]+\)")
+
 def frange(bottom, top, delta):
     #return [x*delta + initial for x in range(1,(final-initial]
     r = []
@@ -78,7 +130,7 @@ def to_int(x):
 def get_time(lines):
     user, system, elapsed = None, None, None
     for line in lines:
-        match = re.search("(.*)user (.*)system (.*)elapsed", line)
+        match = time_regex.search(line)
         if match != None:
             user = match.group(1)
             system = match.group(2)
@@ -109,7 +161,7 @@ def get_group1(lines, regex, index=0):
     return get_by_index(values, index)
 
 def get_all_group1(lines, regex_str):
-    regex = re.compile(regex_str)
+    regex = get_compiled(regex_str)
     values = []
     for line in lines:
         match = regex.search(line)
@@ -122,7 +174,7 @@ def get_match(lines, regex, index=0):
     return get_by_index(values, index)
 
 def get_all_matches(lines, regex_str):
-    regex = re.compile(regex_str)
+    regex = get_compiled(regex_str)
     match_list = []
     for line in lines:
         match = regex.search(line)
@@ -138,21 +190,131 @@ def get_by_index(values, index):
         return values[0]
     return None
 
+# The values returned for a field of a LogExtractor.
+FIRST = "first"
+LAST = "last"
+ALL = "all"
+
+class LogExtractor:
+    '''Extracts many fields from the lines of a log in a single pass.
+
+    Each field has a regex and returns the first, last, or all values of its
+    match (by default, group 1) over the lines, just like the corresponding calls 
+    to get_group1(lines, regex, 0), get_group1(lines, regex, -1) and 
+    get_all_group1(lines, regex). For example:
+
+        extractor = LogExtractor()
+        extractor.add_following_literal("accuracy", "Accuracy: ", LAST)
+        extractor.add_group1("error", "(.*Exception:.*)", FIRST)
+        extractor.add_time("time")
+        values = extractor.extract_file(stdout_file)
+
+    All the regexes are also combined into a single regex, so that most lines 
+    are rejected by one search. Reading stops early once every field is FIRST 
+    and has a value.
+    '''
+
+    def __init__(self):
+        self.fields = [] # List of (name, regex, which, get_value, default).
+        self._combined = None
+
+    def add_group1(self, name, regex, which=LAST):
+        self.add_match(name, regex, which, lambda match: match.group(1))
+
+    def add_following(self, name, prefix, which=LAST, include_prefix=False):
+        if include_prefix:
+            regex = "("+prefix+".*)"
+        else:
+            regex = prefix+"(.*)"
+        self.add_group1(name, regex, which)
+
+    def add_following_literal(self, name, prefix, which=LAST, include_prefix=False):
+        self.add_following(name, re.escape(prefix), which, include_prefix)
+
+    def add_time(self, name="time"):
+        '''Adds a field for the (user, system, elapsed) triple of get_time().'''
+        self.add_match(name, time_regex.pattern, FIRST, lambda match: match.group(1, 2, 3), (None, None, None))
+
+    def add_match(self, name, regex, which=LAST, get_value=lambda match: match, default=None):
+        '''Adds a field whose value is get_value() of a regex match, or default if 
+        a FIRST or LAST field never matches.'''
+        if which not in (FIRST, LAST, ALL):
+            raise ValueError("Invalid field type: " + str(which))
+        self.fields.append((name, get_compiled(regex), which, get_value, default))
+        self._combined = None
+
+    def extract(self, lines):
+        '''Returns a dict mapping each field name to its value, where the value of
+        an ALL field is a list.'''
+        values = {}
+        for name, _, which, _, default in self.fields:
+            values[name] = [] if which == ALL else default
+        combined = self._get_combined()
+        todo = list(self.fields)
+        stop_early = len([f for f in todo if f[2] != FIRST]) == 0
+        for line in lines:
+            if combined is not None and combined.search(line) is None:
+                continue
+            done = []
+            for field in todo:
+                name, regex, which, get_value, _ = field
+                match = regex.search(line)
+                if match is None:
+                    continue
+                if which == ALL:
+                    values[name].append(get_value(match))
+                else:
+                    values[name] = get_value(match)
+                    if which == FIRST:
+                        done.append(field)
+            if len(done) > 0:
+                todo = [f for f in todo if f not in done]
+                if stop_early and len(todo) == 0:
+                    break
+        return values
+
+    def extract_file(self, filename):
+        '''Streams the lines of a file through extract().'''
+        f = open(filename, 'r')
+        try:
+            return self.extract(f)
+        finally:
+            f.close()
+
+    def _get_combined(self):
+        '''Gets one regex which matches a line if any of the fields' regexes do, or 
+        None if they cannot be combined (e.g. due to backreferences, inline flags, which 
+        would apply to all the fields' regexes, or repeated group names).'''
+        if self._combined is None:
+            if len([f for f in self.fields if backreference_regex.search(f[1].pattern) or
+                    inline_flags_regex.search(f[1].pattern)]) > 0:
+                self._combined = False
+                return None
+            try:
+                self._combined = re.compile("|".join(["(?:%s)" % (f[1].pattern) for f in self.fields]))
+            except re.error:
+                self._combined = False
+        return self._combined or None
+
 # ------------------- Paths ------------------------
 
 def get_new_path(f, prefix="temp", suffix="", dir=None):
+    '''Calls f on the first of the paths prefix_000suffix, prefix_001suffix, ... for which
+    it succeeds and returns the result. The function f must create the path, and raise an 
+    OSError with errno EEXIST if it already exists, so that the path is not probed separately.
+    '''
     if(dir != None):
         prefix = os.path.join(dir, prefix)
     prefix = os.path.abspath(prefix)
     num_digits = 3
-    i = 0
     template = prefix + "_%" + str(num_digits) + "." + str(num_digits) + "d" + suffix
-    for i in range(int(math.pow(num_digits,10))):
-        path = template % (i)
-        path = os.path.abspath(path)
-        if not os.path.exists(path):
-            return f(path)
-    raise Exception("Could not create an new file/directory with prefix %s" % (prefix))
+    # This ends since only finitely many of the paths can exist.
+    for i in itertools.count():
+        try:
+            return f(template % (i))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
 
 def get_new_directory(prefix="temp", suffix="", dir=None):
     def f(path):
@@ -162,11 +324,39 @@ def get_new_directory(prefix="temp", suffix="", dir=None):
 
 def get_new_file(prefix="temp", suffix="", dir=None):
     def f(path):
-        return open(path ,'w'), path
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        return os.fdopen(fd, 'w'), path
     return get_new_path(f, prefix=prefix, suffix=suffix,dir=dir)
 
 # ------------------- General utilities ------------------------
 
+class PhaseTimer:
+    '''Accumulates the elapsed time of each phase of a task, where the phases may be 
+    entered more than once.'''
+    
+    def __init__(self):
+        self.phases = []
+        self.times = {}
+        self.phase = None
+        self.start_time = None
+        
+    def start(self, phase):
+        '''Stops the current phase (if any) and starts the given one.'''
+        self.stop()
+        if phase not in self.times:
+            self.phases.append(phase)
+            self.times[phase] = 0.0
+        self.phase = phase
+        self.start_time = time.time()
+        
+    def stop(self):
+        if self.phase is not None:
+            self.times[self.phase] += time.time() - self.start_time
+            self.phase = None
+    
+    def __str__(self):
+        return " ".join(["%s=%.2fs" % (phase, self.times[phase]) for phase in self.phases])
+
 def fancify_cmd(cmd):
     script = 'CMD="time ' + cmd + '"\n'
     script += 'echo $CMD\n'
@@ -25,12 +25,14 @@ if __name__ == "__main__":
     parser = OptionParser(usage=usage)
     parser.add_option(    '--test', action="store_true", help="Run without actually launching anything")
     parser.add_option(    '--tries', type="int", default=1, help="Number of times to attempt launching (for use with unstable SGE)")
+    parser.add_option(    '--workers', type="int", default=1, help="Number of jobs to relaunch concurrently")
+    parser.add_option(    '--backoff', type="float", default=1.0, help="Base number of seconds to wait before retrying a failed launch")
     (options, args) = parser.parse_args(sys.argv)
 
     if len(args) <= 1:
         parser.print_help()
         sys.exit(1)
 
-    relauncher = Relauncher(options.test, options.tries)
+    relauncher = Relauncher(options.test, options.tries, workers=options.workers, backoff_secs=options.backoff)
     for arg in args[1:]:
         relauncher.relaunch(arg)
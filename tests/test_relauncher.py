@@ -0,0 +1,126 @@
+'''
+Tests for pypipeline.relauncher, run against a FakeScheduler.
+
+Run from the top of the repository with: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from pypipeline.relauncher import Relauncher
+from pypipeline.scheduler import FakeScheduler, create_queue_command, get_relaunch_script
+
+class QueuedJob:
+    '''A minimal job with the submission attributes of a Stage (see scheduler.py), which is
+    only submitted to a FakeScheduler so that it is queued.'''
+
+    def __init__(self, name, cwd):
+        self.name = name
+        self.cwd = cwd
+        self.stdout_path = os.devnull
+        self.script_file = os.path.join(cwd, "script.sh")
+        self.qsub_args = None
+        self.tasks = None
+        self.script_prefix = name + "-"
+        self.qdel_script_file = None
+
+    def get_qsub_name(self):
+        return self.name
+
+    def get_prereq_hold_names(self):
+        return []
+
+class NoSleepRelauncher(Relauncher):
+    '''A Relauncher which records its backoffs between tries instead of sleeping.'''
+
+    def __init__(self, *args, **kwargs):
+        Relauncher.__init__(self, *args, **kwargs)
+        self.backoffs = []
+
+    def _get_backoff_secs(self, attempt):
+        self.backoffs.append(Relauncher._get_backoff_secs(self, attempt))
+        return 0
+
+class RelauncherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top_dir = tempfile.mkdtemp(prefix="test_relauncher")
+        self.scheduler = FakeScheduler()
+
+    def tearDown(self):
+        shutil.rmtree(self.top_dir)
+
+    def _add_exp_dir(self, name, done=False, parent_job_name=None, qsub_command=None):
+        '''Creates an experiment directory with a qsub script for the job name.'''
+        exp_dir = os.path.join(self.top_dir, name)
+        os.mkdir(exp_dir)
+        if done:
+            open(os.path.join(exp_dir, "DONE"), 'w').close()
+        if qsub_command is None:
+            qsub_command = create_queue_command(os.path.join(exp_dir, "script.sh"), exp_dir, name)
+        if parent_job_name is None:
+            script = qsub_command
+        else:
+            script = get_relaunch_script(qsub_command, parent_job_name)
+        out = open(os.path.join(exp_dir, "qsub-script_000.sh"), 'w')
+        out.write(script + "\n")
+        out.close()
+        return exp_dir
+
+    def _queue(self, name):
+        self.scheduler.submit([QueuedJob(name, self.top_dir)])
+
+    def _relaunch(self):
+        r = Relauncher(True, 1, scheduler=self.scheduler)
+        r.relaunch(self.top_dir)
+        return r
+
+    def test_done_is_skipped(self):
+        self._add_exp_dir("exp1", done=True)
+        self._add_exp_dir("exp2")
+        r = self._relaunch()
+        self.assertEqual((1, 0, 1), (r.done_count, r.running_count, r.relaunch_count))
+
+    def test_queued_job_is_running(self):
+        self._add_exp_dir("exp1")
+        self._add_exp_dir("exp2")
+        self._queue("exp1")
+        r = self._relaunch()
+        self.assertEqual((0, 1, 1), (r.done_count, r.running_count, r.relaunch_count))
+
+    def test_queued_parent_job_is_running(self):
+        # E.g. the stages of a bundle or chain job, which is still queued.
+        for name in ["exp1", "exp2", "exp3"]:
+            self._add_exp_dir(name, parent_job_name="bundle_exp1")
+        self._add_exp_dir("exp4", parent_job_name="chain_exp4")
+        self._queue("bundle_exp1")
+        r = self._relaunch()
+        self.assertEqual((0, 3, 1), (r.done_count, r.running_count, r.relaunch_count))
+        # Once the parent job has finished, its unfinished stages are relaunched.
+        self.scheduler.run_jobs()
+        r = self._relaunch()
+        self.assertEqual((0, 0, 4), (r.done_count, r.running_count, r.relaunch_count))
+
+    def test_failed_submit_retries_and_raises(self):
+        count_file = os.path.join(self.top_dir, "count.txt")
+        self._add_exp_dir("exp1", qsub_command="echo try >> '%s'; exit 1" % (count_file))
+        r = NoSleepRelauncher(False, 3, scheduler=self.scheduler, backoff_secs=1.0, max_backoff_secs=1.5)
+        self.assertRaises(Exception, r.relaunch, self.top_dir)
+        self.assertEqual(3, len(open(count_file, 'r').readlines()))
+        self.assertEqual((1, 0), (r.failed_count, r.relaunch_count))
+        # There is a backoff between tries, but not after the last try.
+        self.assertEqual(2, len(r.backoffs))
+        self.assertTrue(0 <= r.backoffs[0] <= 1.0)
+        self.assertTrue(0 <= r.backoffs[1] <= 1.5)
+
+    def test_successful_submit(self):
+        exp_dir = self._add_exp_dir("exp1", qsub_command="echo submitted > submitted.txt")
+        r = NoSleepRelauncher(False, 3, scheduler=self.scheduler)
+        r.relaunch(self.top_dir)
+        self.assertEqual((1, 0), (r.relaunch_count, r.failed_count))
+        self.assertTrue(os.path.exists(os.path.join(exp_dir, "submitted.txt")))
+        self.assertEqual([], r.backoffs)
+
+if __name__ == '__main__':
+    unittest.main()
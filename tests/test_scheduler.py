@@ -0,0 +1,131 @@
+'''
+Tests for the scheduler backends in pypipeline.scheduler.
+
+Run from the top of the repository with: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from pypipeline.scheduler import create_queue_command, SgeScheduler, SlurmScheduler, FakeScheduler, \
+    QUEUED, DONE
+
+class FakeJob:
+    '''A minimal job with the submission attributes of a Stage (see scheduler.py), whose
+    script appends its name to a log file.'''
+
+    def __init__(self, name, hold_names, cwd, log_file):
+        self.name = name
+        self.hold_names = hold_names
+        self.cwd = cwd
+        self.stdout_path = os.path.join(cwd, name + ".stdout")
+        self.script_file = os.path.join(cwd, name + ".sh")
+        self.qsub_args = None
+        self.tasks = None
+        self.script_prefix = name + "-"
+        self.qdel_script_file = None
+        self.priority = None
+        out = open(self.script_file, 'w')
+        out.write("echo %s >> '%s'\n" % (name, log_file))
+        out.close()
+
+    def get_qsub_name(self):
+        return self.name
+
+    def get_prereq_hold_names(self):
+        return self.hold_names
+
+class CommandTest(unittest.TestCase):
+
+    def test_sge_submit_command(self):
+        cmd = SgeScheduler().get_submit_command("/exp/s1/script.sh", "/exp/s1", "s1_job", ["a", "b"],
+                                                "/exp/s1/stdout", "-q all.q", (1, 3), 0.5)
+        self.assertEqual(create_queue_command("/exp/s1/script.sh", "/exp/s1", "s1_job", ["a", "b"],
+                                              "/exp/s1/stdout", "-q all.q", (1, 3), 0.5), cmd)
+        self.assertEqual(["qsub", "-q", "all.q", "-cwd", "-j", "y", "-b", "y", "-V", "-N", "s1_job",
+                          "-e", "stderr", "-o", "stdout", "-t", "1-3", "-p", "-512", "-hold_jid", "a,b",
+                          "\"bash", "'script.sh'\""], cmd.split())
+
+    def test_sge_submit_command_defaults(self):
+        cmd = SgeScheduler().get_submit_command("/exp/s1/script.sh", "/exp/s1", "s1_job", [],
+                                                os.devnull, None)
+        self.assertIn("-o %s " % (os.devnull), cmd)
+        self.assertNotIn("-hold_jid", cmd)
+        self.assertNotIn("-t ", cmd)
+        self.assertNotIn("-p ", cmd)
+
+    def test_sge_priority_range(self):
+        self.assertIn("-p 0 ", create_queue_command("s.sh", ".", priority=1.0))
+        self.assertIn("-p -1023 ", create_queue_command("s.sh", ".", priority=0.0))
+
+    def test_sge_cancel_command(self):
+        self.assertEqual("qdel a,b", SgeScheduler().get_cancel_command(["a", "b"]))
+
+    def test_slurm_submit_command(self):
+        scheduler = SlurmScheduler(partition="gpu")
+        scheduler.name_to_id["a"] = "17"
+        args = scheduler.get_resource_args("cpu", 2, 1024, 90)
+        self.assertEqual(["--cpus-per-task=2", "--mem=1024M", "--time=01:30:00", "--partition=gpu"], args.split())
+        cmd = scheduler.get_submit_command("/exp/s1/script.sh", "/exp/s1", "s1_job", ["a", "b"],
+                                           "/exp/s1/stdout", args, (1, 3), 0.5)
+        # The hold on b is dropped, since b was not submitted by this scheduler.
+        self.assertEqual(["sbatch", "--parsable"] + args.split() +
+                         ["-J", "s1_job", "-o", "stdout", "--array=1-3", "--nice=512",
+                          "--dependency=afterok:17", "--wrap", "\"bash", "'script.sh'\""], cmd.split())
+
+    def test_slurm_cancel_command(self):
+        self.assertEqual("scancel 1 2", SlurmScheduler().get_cancel_command(["1", "2"]))
+
+class FakeSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="test_scheduler")
+        self.log_file = os.path.join(self.dir, "log.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _get_job(self, name, hold_names):
+        return FakeJob(name, hold_names, self.dir, self.log_file)
+
+    def _read_log(self):
+        return open(self.log_file, 'r').read().split()
+
+    def test_holds_order_jobs(self):
+        # A diamond: b and c hold on a, and d holds on b and c.
+        jobs = [self._get_job("a", []), self._get_job("b", ["a"]), self._get_job("c", ["a"]),
+                self._get_job("d", ["b", "c"])]
+        scheduler = FakeScheduler(execute=True)
+        self.assertEqual(["a", "b", "c", "d"], scheduler.submit(jobs))
+        self.assertEqual(dict((name, QUEUED) for name in "abcd"), scheduler.status(["a", "b", "c", "d"]))
+        scheduler.run_jobs()
+        log = self._read_log()
+        self.assertEqual(["a", "b", "c", "d"], sorted(log))
+        self.assertEqual("a", log[0])
+        self.assertEqual("d", log[-1])
+        self.assertEqual([DONE] * 4, [job.state for job in scheduler.jobs.values()])
+        # Finished jobs are no longer known to qstat.
+        self.assertEqual({"a": None}, scheduler.status(["a"]))
+        self.assertEqual([], scheduler.unknown_holds)
+
+    def test_unknown_holds_are_ignored(self):
+        # As on SGE, a hold on a job which was not (yet) submitted is ignored.
+        scheduler = FakeScheduler(execute=True)
+        scheduler.submit([self._get_job("b", ["a"])])
+        scheduler.submit([self._get_job("a", [])])
+        self.assertEqual([("b", "a")], scheduler.unknown_holds)
+        scheduler.run_jobs()
+        self.assertEqual(["b", "a"], self._read_log())
+
+    def test_cancel_and_qdel_scripts(self):
+        scheduler = FakeScheduler()
+        jobs = [self._get_job("a", []), self._get_job("b", ["a"])]
+        scheduler.submit(jobs)
+        for job in jobs:
+            self.assertTrue(os.path.exists(job.qdel_script_file))
+        scheduler.cancel(["a"])
+        self.assertEqual({"a": None, "b": QUEUED}, scheduler.status(["a", "b"]))
+
+if __name__ == '__main__':
+    unittest.main()
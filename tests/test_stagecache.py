@@ -0,0 +1,64 @@
+'''
+Tests for pypipeline.stagecache.
+
+Run from the top of the repository with: python -m unittest discover tests
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+from pypipeline.stagecache import StageCache, unlink_entry, LINKS_FILE
+
+class StageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="test_stagecache")
+        self.cache = StageCache(os.path.join(self.dir, "cache"))
+        self.cwd = os.path.join(self.dir, "stage")
+        os.mkdir(self.cwd)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, path, text):
+        out = open(path, 'w')
+        out.write(text)
+        out.close()
+
+    def _add_entry(self, stage_hash):
+        entry_dir = self.cache.get_entry_dir(stage_hash)
+        os.makedirs(os.path.join(entry_dir, "sub"))
+        self._write(os.path.join(entry_dir, "out.txt"), "cached")
+        self._write(os.path.join(entry_dir, "sub", "model.txt"), "cached")
+        self._write(os.path.join(entry_dir, "DONE"), "")
+
+    def test_miss(self):
+        self.assertFalse(self.cache.link("h", self.cwd, "DONE"))
+        self.assertEqual([], os.listdir(self.cwd))
+
+    def test_link_and_unlink(self):
+        self._add_entry("h")
+        # A file of the stage's own, which is hard linked from elsewhere.
+        self._write(os.path.join(self.dir, "data.txt"), "mine")
+        os.link(os.path.join(self.dir, "data.txt"), os.path.join(self.cwd, "data.txt"))
+        self.assertTrue(self.cache.link("h", self.cwd, "DONE"))
+        self.assertEqual("cached", open(os.path.join(self.cwd, "sub", "model.txt")).read())
+        self.assertTrue(os.path.exists(os.path.join(self.cwd, "DONE")))
+        self.assertTrue(unlink_entry(self.cwd))
+        self.assertEqual(["data.txt"], os.listdir(self.cwd))
+        # The entry is unchanged.
+        self.assertEqual("cached", open(os.path.join(self.cache.get_entry_dir("h"), "out.txt")).read())
+        self.assertFalse(unlink_entry(self.cwd))
+
+    def test_existing_files_are_kept(self):
+        self._add_entry("h")
+        self._write(os.path.join(self.cwd, "out.txt"), "mine")
+        self.assertTrue(self.cache.link("h", self.cwd, "DONE"))
+        self.assertNotIn("out.txt", open(os.path.join(self.cwd, LINKS_FILE)).read().split())
+        unlink_entry(self.cwd)
+        self.assertEqual(["out.txt"], os.listdir(self.cwd))
+        self.assertEqual("mine", open(os.path.join(self.cwd, "out.txt")).read())
+
+if __name__ == '__main__':
+    unittest.main()
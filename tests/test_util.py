@@ -0,0 +1,54 @@
+'''
+Tests for the scraping utilities in pypipeline.util.
+
+Run from the top of the repository with: python -m unittest discover tests
+'''
+
+import unittest
+from pypipeline.util import LogExtractor, get_group1, get_all_group1, FIRST, LAST, ALL
+
+class LogExtractorTest(unittest.TestCase):
+
+    def _check_like_get_group1(self, extractor, lines, fields):
+        '''Checks that each (name, regex, which) field has the value from get_group1/get_all_group1.'''
+        values = extractor.extract(lines)
+        for name, regex, which in fields:
+            if which == ALL:
+                expected = get_all_group1(lines, regex)
+            else:
+                expected = get_group1(lines, regex, 0 if which == FIRST else -1)
+            self.assertEqual(expected, values[name], name)
+
+    def _get_extractor(self, fields):
+        extractor = LogExtractor()
+        for name, regex, which in fields:
+            extractor.add_group1(name, regex, which)
+        return extractor
+
+    def test_fields(self):
+        lines = ["iter 1 loss 0.5", "Accuracy is 0.8", "iter 2 loss 0.25", "Accuracy is 0.9", "done"]
+        fields = [("first_loss", r"loss (\S+)", FIRST),
+                  ("last_loss", r"loss (\S+)", LAST),
+                  ("iters", r"iter (\d+)", ALL),
+                  ("accuracy", r"Accuracy is (\S+)", LAST),
+                  ("missing", r"Error: (.*)", LAST)]
+        self._check_like_get_group1(self._get_extractor(fields), lines, fields)
+
+    def test_inline_flags(self):
+        # An inline flag applies to the whole regex, so it must not be combined with the
+        # regexes of the other fields.
+        lines = ["Accuracy is 0.9", "foo3"]
+        fields = [("a", r"(?x) foo(\d+)", LAST),
+                  ("b", r"Accuracy is (\S+)", LAST)]
+        extractor = self._get_extractor(fields)
+        self._check_like_get_group1(extractor, lines, fields)
+        self.assertEqual("0.9", extractor.extract(lines)["b"])
+
+    def test_backreferences(self):
+        lines = ["ab ab", "ab cd", "x=1"]
+        fields = [("repeat", r"(\w+) \1", ALL),
+                  ("x", r"x=(\d+)", LAST)]
+        self._check_like_get_group1(self._get_extractor(fields), lines, fields)
+
+if __name__ == '__main__':
+    unittest.main()